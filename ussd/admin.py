@@ -1,11 +1,88 @@
+from django.conf import settings
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList, ALL_VAR, ORDER_VAR, ORDER_TYPE_VAR, SEARCH_VAR, IS_POPUP_VAR
+from .graph import load_typed
 from .models import Screen, Menu, Question, Field
 from mptt.admin import MPTTModelAdmin
 
-admin.site.register(Screen, MPTTModelAdmin)
-admin.site.register(Question, MPTTModelAdmin)
-admin.site.register(Field, MPTTModelAdmin)
-admin.site.register(Menu, MPTTModelAdmin)
+PARENT_VAR = 'parent'
 
 
+class ScreenChangeList(ChangeList):
+    """
+    For admins with ``lazy_tree`` set, lists root screens only, a page at a
+    time, unless the list is being searched or filtered.  With
+    ?parent=<slug>, lists that screen's children instead (see the
+    javascript in admin/mptt_change_list.html).  The rows shown are downcast
+    to their most specific type, with one query per Screen subclass.
+    """
 
+    def __init__(self, request, *args, **kwargs):
+        self.parent = request.GET.get(PARENT_VAR)
+        ChangeList.__init__(self, request, *args, **kwargs)
+
+    def get_query_set(self, *args, **kwargs):
+        self.params.pop(PARENT_VAR, None)
+        if not getattr(self.model_admin, 'lazy_tree', False):
+            self.parent = None
+        filtered = [k for k in self.params if k not in (ALL_VAR, ORDER_VAR, ORDER_TYPE_VAR, SEARCH_VAR, IS_POPUP_VAR)]
+        self.lazy = getattr(self.model_admin, 'lazy_tree', False) and self.parent is None and not self.query and not filtered
+        # rows with children get a toggle to fetch them, at every level
+        self.expandable = self.lazy or self.parent is not None
+        qs = ChangeList.get_query_set(self, *args, **kwargs)
+        opts = self.model._mptt_meta
+        if ORDER_VAR not in self.params:
+            # the admin only orders by the first of ScreenAdmin.ordering
+            qs = qs.order_by(opts.tree_id_attr, opts.left_attr)
+        if self.parent is not None:
+            try:
+                node = self.model._tree_manager.get(pk=self.parent)
+            except self.model.DoesNotExist:
+                # deleted since the page showing it was loaded
+                return qs.none()
+            return qs.filter(**{
+                opts.tree_id_attr:getattr(node, opts.tree_id_attr),
+                '%s__gt' % opts.left_attr:getattr(node, opts.left_attr),
+                '%s__lt' % opts.right_attr:getattr(node, opts.right_attr),
+                opts.level_attr:getattr(node, opts.level_attr) + 1,
+            })
+        if self.lazy:
+            return qs.filter(**{opts.level_attr:0})
+        return qs
+
+    def get_results(self, request):
+        if self.parent is not None:
+            # all of a screen's children fit on one page
+            self.list_per_page = getattr(settings, 'USSD_ADMIN_MAX_CHILDREN', 1000)
+        ChangeList.get_results(self, request)
+        typed = load_typed([result.pk for result in self.result_list])
+        self.result_list = [typed.get(result.pk, result) for result in self.result_list]
+
+
+class ScreenAdmin(MPTTModelAdmin):
+    ordering = ('tree_id', 'lft')
+    change_list_template = 'admin/mptt_change_list.html'
+    # only the Screen changelist holds whole trees, a subclass's rows can
+    # be at any level, with parents of other types
+    lazy_tree = True
+
+    def get_changelist(self, request, **kwargs):
+        return ScreenChangeList
+
+    def changelist_view(self, request, extra_context=None):
+        extra_context = dict(extra_context or {}, parent_var=PARENT_VAR)
+        response = super(ScreenAdmin, self).changelist_view(request, extra_context)
+        if self.lazy_tree and PARENT_VAR in request.GET and hasattr(response, 'template_name'):
+            # just the rows, for the changelist to insert
+            response.template_name = 'admin/mptt_change_list_subtree.html'
+        return response
+
+
+class ScreenTypeAdmin(ScreenAdmin):
+    lazy_tree = False
+
+
+admin.site.register(Screen, ScreenAdmin)
+admin.site.register(Question, ScreenTypeAdmin)
+admin.site.register(Field, ScreenTypeAdmin)
+admin.site.register(Menu, ScreenTypeAdmin)
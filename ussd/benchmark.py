@@ -0,0 +1,199 @@
+"""
+Tools for benchmarking the gateway's hot path: synthetic Screen trees,
+scripted sessions walked through them, and a driver that replays those
+sessions through the ussd view and reports throughput, latency and
+queries per hop.  See the ussd_benchmark management command.
+
+Hops are measured with navigations and screen counters written as they
+happen, rather than by the background flushers, so their queries are
+counted against the hop that made them.  The generated tree lives in the
+Screen tables, so published tree versions are ignored while it runs.
+"""
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.client import RequestFactory
+from rapidsms_xforms.models import XForm, XFormField
+
+from .graph import get_graph
+from .instrumentation import percentile
+from .models import Screen, Menu, Question, Field, StubScreen, Session
+from .views import ussd
+
+
+# settings for the duration of a run, see overridden()
+BENCH_SETTINGS = {
+    'USSD_NAVIGATION_SYNC':True,
+    'USSD_STATS_SYNC':True,
+    'USSD_TREE_VERSIONS':False,
+}
+
+_missing = object()
+
+
+@contextmanager
+def overridden(**values):
+    """
+    Sets the given settings for the duration of the block.
+    """
+    previous = dict((name, getattr(settings, name, _missing)) for name in values)
+    for name, value in values.items():
+        setattr(settings, name, value)
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            if value is _missing:
+                delattr(settings._wrapped, name)
+            else:
+                setattr(settings, name, value)
+
+
+def build_tree(prefix='bench', depth=3, breadth=4, mix=(1, 1, 1)):
+    """
+    Creates a tree of Menus ``depth`` levels deep, each with ``breadth``
+    children.  The bottom level is a mix of empty Menus, Questions and
+    Fields, in the proportions given by ``mix``; Questions and Fields lead
+    on to a terminal StubScreen.  Returns the root Menu.
+    """
+    owner = User.objects.get_or_create(username='%s_owner' % prefix)[0]
+    xform = XForm.objects.create(keyword=prefix, name=prefix, response='thanks', owner=owner, site=Site.objects.get_current())
+    end = StubScreen.objects.create(slug='%s_end' % prefix, label='End')
+    kinds = ['menu'] * mix[0] + ['question'] * mix[1] + ['field'] * mix[2]
+
+    root = Menu.objects.create(slug='%s_root' % prefix, label='Root')
+    level = [root]
+    for d in range(1, depth + 1):
+        next_level = []
+        for parent in level:
+            for order in range(1, breadth + 1):
+                slug = '%s_%s' % (parent.slug, order)
+                label = 'Option %s' % order
+                if d < depth:
+                    screen = Menu.objects.create(slug=slug, label=label, order=order, parent=parent)
+                else:
+                    kind = kinds[(len(next_level)) % len(kinds)]
+                    if kind == 'menu':
+                        screen = Menu.objects.create(slug=slug, label=label, order=order, parent=parent)
+                    elif kind == 'question':
+                        screen = Question.objects.create(slug=slug, label=label, order=order, parent=parent, question_text='What is %s?' % label, next=end)
+                    else:
+                        command = 'f%d' % len(next_level)
+                        field = XFormField.objects.create(xform=xform, name=command, command=command, field_type=XFormField.TYPE_INT, question='How many %s?' % label, order=len(next_level))
+                        screen = Field.objects.create(slug=slug, label=label, order=order, parent=parent, question_text=field.question, field=field, next=end)
+                next_level.append(screen)
+        level = next_level
+    return root
+
+
+def destroy_tree(prefix='bench'):
+    Session.objects.filter(transaction_id__startswith=prefix).delete()
+    Screen.objects.filter(slug__startswith=prefix).delete()
+    XForm.objects.filter(keyword=prefix).delete()
+    User.objects.filter(username='%s_owner' % prefix).delete()
+
+
+def script_session(root, rng, invalid=0.0, back=0.0):
+    """
+    Returns the inputs for one session walking from ``root`` down to a
+    terminal screen, choosing menu options at random.  With probability
+    ``invalid`` a hop sends input the screen can't accept first, and with
+    probability ``back`` the user goes back and chooses again.
+    """
+    graph = get_graph()
+    back_key = getattr(settings, 'BACK_KEY', '#')
+    inputs = ['']
+    slug = root
+    while True:
+        screen = graph.screen(slug)
+        if screen.is_terminal():
+            return inputs
+        if isinstance(screen, (Menu, Field)) and rng.random() < invalid:
+            inputs.append('x' if isinstance(screen, Field) else '99')
+        if isinstance(screen, Menu):
+            children = graph.get_children(slug)
+            child = rng.choice(children)
+            if not graph.screen(child.slug).is_terminal() and rng.random() < back:
+                inputs.extend([str(child.order), back_key])
+                child = rng.choice(children)
+            inputs.append(str(child.order))
+            slug = child.slug
+        else:
+            inputs.append(str(rng.randint(1, 100)))
+            slug = screen.next_id
+
+
+def post_hop(view, factory, url, transaction_id, input, first, msisdn='256700000000'):
+    response = view(factory.post(url, {
+        'transactionId':transaction_id,
+        'transactionTime':time.strftime('%Y%m%dT%H:%M:%S'),
+        'msisdn':msisdn,
+        'ussdServiceCode':'300',
+        'ussdRequestString':input,
+        'response':'false' if first else 'true',
+    }))
+    # as a WSGI server would, this runs any work deferred past the response
+    response.close()
+    return response
+
+
+def run(scripts, prefix='bench', view=ussd):
+    """
+    Replays each script as a session through the view, in-process, and
+    returns the measured results.
+    """
+    factory = RequestFactory()
+    url = reverse('ussd-gateway')
+    latencies = []
+    queries = []
+
+    use_debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    start = time.time()
+    try:
+        with overridden(**BENCH_SETTINGS):
+            for i, script in enumerate(scripts):
+                transaction_id = '%s%d' % (prefix, i)
+                for hop, input in enumerate(script):
+                    first_query = len(connection.queries)
+                    hop_start = time.time()
+                    post_hop(view, factory, url, transaction_id, input, hop == 0)
+                    latencies.append((time.time() - hop_start) * 1000)
+                    queries.append(len(connection.queries) - first_query)
+                    # keep the query log from growing for the whole run
+                    del connection.queries[:]
+    finally:
+        connection.use_debug_cursor = use_debug_cursor
+    elapsed = time.time() - start
+
+    return summarize(latencies, queries, elapsed, sessions=len(scripts))
+
+
+def summarize(latencies, queries, elapsed, **extra):
+    latencies = sorted(latencies)
+    queries = sorted(queries)
+    hops = len(latencies)
+    results = {
+        'hops':hops,
+        'elapsed':elapsed,
+        'hops_per_second':hops / elapsed if elapsed else None,
+        'latency_ms':{
+            'p50':percentile(latencies, 50),
+            'p95':percentile(latencies, 95),
+            'p99':percentile(latencies, 99),
+            'max':latencies[-1] if latencies else None,
+        },
+    }
+    if queries:
+        results['queries_per_hop'] = {
+            'mean':float(sum(queries)) / len(queries),
+            'p95':percentile(queries, 95),
+            'max':queries[-1],
+        }
+    results.update(extra)
+    return results
@@ -0,0 +1,156 @@
+"""
+Write-behind buffering of Navigation rows.
+
+Navigations are an audit log that nothing on the gateway's path reads back
+(the live stack is Session.stack), so instead of inserting them inside the
+request they are queued here and written by a background thread, in
+batches of USSD_NAVIGATION_BATCH_SIZE rows or every
+USSD_NAVIGATION_FLUSH_INTERVAL milliseconds, whichever comes first.
+Whatever is still queued is written when the process exits.
+
+Set USSD_NAVIGATION_SYNC = True (e.g. in tests) to write every navigation
+as soon as it is logged.
+"""
+import atexit
+import logging
+import threading
+
+from django.conf import settings
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+
+def _writable(navigations):
+    """
+    The navigations whose screen has a row to refer to.  Stub screens made
+    up on the fly have none, and sessions pinned to a tree version can show
+    screens since deleted from the Screen tables.
+    """
+    from .models import Screen
+    slugs = set(nav.screen_id for nav in navigations if nav.screen_id)
+    missing = slugs - set(Screen.objects.filter(pk__in=slugs).values_list('pk', flat=True))
+    if missing:
+        logger.warning('Dropped navigations of deleted screens: %s' % ', '.join(sorted(missing)))
+    return [nav for nav in navigations if nav.screen_id and nav.screen_id not in missing]
+
+
+@transaction.commit_on_success
+def _insert_navigations(navigations):
+    from .models import Navigation, save_texts
+    save_texts(navigations)
+    if hasattr(Navigation.objects, 'bulk_create'):
+        Navigation.objects.bulk_create(navigations)
+    else:
+        for nav in navigations:
+            nav.save()
+
+
+def write_navigations(navigations):
+    """
+    Writes the navigations in one transaction.  If that fails they are
+    written one at a time, so a bad row doesn't lose the rest of the batch.
+    """
+    from .models import forget_texts
+    navigations = _writable(navigations)
+    if not navigations:
+        return
+    try:
+        _insert_navigations(navigations)
+        return
+    except Exception:
+        if len(navigations) == 1:
+            raise
+        logger.exception('Could not write %d navigations at once, writing them one at a time' % len(navigations))
+    # texts written by the rolled back transaction are gone again
+    forget_texts(navigations)
+    dropped = 0
+    for nav in navigations:
+        try:
+            _insert_navigations([nav])
+        except Exception:
+            forget_texts([nav])
+            logger.exception('Dropped the navigation of session %s on %s' % (nav.session_id, nav.screen_id))
+            dropped += 1
+    if dropped:
+        logger.error('Dropped %d of %d navigations' % (dropped, len(navigations)))
+
+
+class NavigationBuffer(object):
+
+    def __init__(self, batch_size=100, interval=500):
+        self.batch_size = batch_size
+        self.interval = interval / 1000.0
+        self.navigations = []
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def add(self, navigations):
+        self.condition.acquire()
+        try:
+            self.navigations.extend(navigations)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='ussd-navigation-flusher')
+                self.thread.setDaemon(True)
+                self.thread.start()
+            if len(self.navigations) >= self.batch_size:
+                self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def take(self):
+        self.condition.acquire()
+        try:
+            navigations, self.navigations = self.navigations, []
+            return navigations
+        finally:
+            self.condition.release()
+
+    def flush(self):
+        navigations = self.take()
+        if navigations:
+            try:
+                write_navigations(navigations)
+            except Exception:
+                logger.exception('Dropped %d navigations that could not be written' % len(navigations))
+
+    def run(self):
+        while True:
+            self.condition.acquire()
+            try:
+                if len(self.navigations) < self.batch_size:
+                    self.condition.wait(self.interval)
+            finally:
+                self.condition.release()
+            self.flush()
+
+
+_buffer = None
+_lock = threading.Lock()
+
+
+def get_navigation_buffer():
+    global _buffer
+    if _buffer is None:
+        _lock.acquire()
+        try:
+            if _buffer is None:
+                _buffer = NavigationBuffer(
+                    getattr(settings, 'USSD_NAVIGATION_BATCH_SIZE', 100),
+                    getattr(settings, 'USSD_NAVIGATION_FLUSH_INTERVAL', 500))
+                atexit.register(_buffer.flush)
+        finally:
+            _lock.release()
+    return _buffer
+
+
+def log_navigations(navigations):
+    """
+    Queues Navigation instances to be written to the database.
+    """
+    if not navigations:
+        return
+    if getattr(settings, 'USSD_NAVIGATION_SYNC', False):
+        write_navigations(navigations)
+    else:
+        get_navigation_buffer().add(navigations)
@@ -0,0 +1,138 @@
+"""
+Resolving a subscriber's msisdn to their rapidsms Connection.
+
+Backends are routed by number prefix (see ussd.routing), but
+Connection.objects.get_or_create() still costs a query or two, for an
+answer that hardly ever changes, so resolved connections are kept in a
+per-process LRU cache of at most USSD_CONNECTION_CACHE_SIZE msisdns, each
+for up to USSD_CONNECTION_CACHE_TTL seconds.  The whole row is cached
+(contact included), and saving or deleting any Connection empties the
+cache.  Those signals are only seen by the process that made the change,
+so a session store that finds its connection has been deleted elsewhere
+resolves it again with refresh_connection().
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+from rapidsms.models import Connection
+
+from .routing import route
+
+
+class LRUCache(object):
+    """
+    A thread-safe mapping of at most ``size`` entries, each expiring
+    ``ttl`` seconds after it was set.  The least recently used entry is
+    evicted first.
+    """
+
+    def __init__(self, size=10000, ttl=3600):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        self.lock.acquire()
+        try:
+            try:
+                expires, value = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            if expires < time.time():
+                self.misses += 1
+                return None
+            # move it to the most recently used end
+            self.entries[key] = (expires, value)
+            self.hits += 1
+            return value
+        finally:
+            self.lock.release()
+
+    def set(self, key, value):
+        self.lock.acquire()
+        try:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl, value)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        return {'size':len(self.entries), 'hits':self.hits, 'misses':self.misses}
+
+
+_cache = None
+_lock = threading.Lock()
+
+
+def get_connection_cache():
+    global _cache
+    if _cache is None:
+        _lock.acquire()
+        try:
+            if _cache is None:
+                _cache = LRUCache(getattr(settings, 'USSD_CONNECTION_CACHE_SIZE', 10000),
+                                  getattr(settings, 'USSD_CONNECTION_CACHE_TTL', 3600))
+        finally:
+            _lock.release()
+    return _cache
+
+
+def resolve_connection(msisdn):
+    """
+    Returns the Connection for ``msisdn``, creating it if need be.  Cached
+    connections are rebuilt from all their column values, without a query.
+    """
+    cache = get_connection_cache()
+    cached = cache.get(msisdn)
+    if cached is not None:
+        return _rebuild(cached)
+    identity, backend = route(msisdn)
+    c, created = Connection.objects.get_or_create(identity=identity, backend=backend)
+    cache.set(msisdn, _values(c))
+    return c
+
+
+def refresh_connection(connection):
+    """
+    Returns the current Connection for a cached ``connection`` whose row
+    turned out to be gone (deleted by another process), creating it again
+    if need be.  The cache is emptied, as other entries may be stale too.
+    """
+    get_connection_cache().clear()
+    c, created = Connection.objects.get_or_create(identity=connection.identity, backend=connection.backend_id)
+    return c
+
+
+def _values(connection):
+    return dict((f.attname, getattr(connection, f.attname)) for f in Connection._meta.fields)
+
+
+def _rebuild(values):
+    connection = Connection(**values)
+    # as if it had been loaded by a queryset
+    connection._state.adding = False
+    connection._state.db = 'default'
+    return connection
+
+
+def connection_changed(sender, **kwargs):
+    get_connection_cache().clear()
+
+post_save.connect(connection_changed, sender=Connection, dispatch_uid='ussd.connections.post_save')
+post_delete.connect(connection_changed, sender=Connection, dispatch_uid='ussd.connections.post_delete')
@@ -0,0 +1,138 @@
+"""
+Per-screen, per-day counters, kept up to date as sessions move along.
+
+Sessions count a view for each screen they show (including the one a back
+navigation returns to), and an error, advance, completion or dropoff for
+the screen they leave (see ussd.funnel, which derives the same figures
+from Navigation, for what each means).  Counts are added up in memory and written to ScreenStat
+every USSD_STATS_FLUSH_INTERVAL seconds (10 by default) by a background
+thread, one upsert per (screen, day, outcome), so dashboards read a few
+rows per screen instead of scanning Navigation.  Whatever hasn't been
+written yet is flushed when the process exits.
+
+Set USSD_STATS_SYNC = True (e.g. in tests) to write every count straight
+away, or USSD_SCREEN_STATS = False to stop counting.  The
+ussd_rebuild_stats command recomputes the table from Navigation.
+"""
+import atexit
+import datetime
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.db.models import F
+
+logger = logging.getLogger(__name__)
+
+
+@transaction.commit_on_success
+def write_counts(counts):
+    from .models import Screen, ScreenStat
+    # sessions pinned to a tree version can show screens since deleted
+    # from the Screen tables, whose rows would fail the whole batch
+    slugs = set(slug for slug, day, outcome in counts)
+    missing = slugs - set(Screen.objects.filter(pk__in=slugs).values_list('pk', flat=True))
+    if missing:
+        logger.warning('Dropped counts of deleted screens: %s' % ', '.join(sorted(missing)))
+    for (slug, day, outcome), n in counts.items():
+        if slug in missing:
+            continue
+        stats = ScreenStat.objects.filter(screen=slug, day=day, outcome=outcome)
+        if stats.update(count=F('count') + n):
+            continue
+        # another process may be creating the same row
+        sid = transaction.savepoint()
+        try:
+            ScreenStat.objects.create(screen_id=slug, day=day, outcome=outcome, count=n)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+            stats.update(count=F('count') + n)
+
+
+class ScreenCounters(object):
+
+    def __init__(self, interval=10):
+        self.interval = interval
+        self.counts = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def add(self, slug, outcome, day):
+        self.lock.acquire()
+        try:
+            key = (slug, day, outcome)
+            self.counts[key] = self.counts.get(key, 0) + 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='ussd-stats-flusher')
+                self.thread.setDaemon(True)
+                self.thread.start()
+        finally:
+            self.lock.release()
+
+    def take(self):
+        self.lock.acquire()
+        try:
+            counts, self.counts = self.counts, {}
+            return counts
+        finally:
+            self.lock.release()
+
+    def flush(self):
+        counts = self.take()
+        if counts:
+            try:
+                write_counts(counts)
+            except Exception:
+                logger.exception('Dropped %d screen counts that could not be written' % len(counts))
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+
+_counters = None
+_lock = threading.Lock()
+
+
+def get_counters():
+    global _counters
+    if _counters is None:
+        _lock.acquire()
+        try:
+            if _counters is None:
+                _counters = ScreenCounters(getattr(settings, 'USSD_STATS_FLUSH_INTERVAL', 10))
+                atexit.register(_counters.flush)
+        finally:
+            _lock.release()
+    return _counters
+
+
+def count_screen(slug, outcome, day=None):
+    """
+    Counts one ``outcome`` ('views', 'errors', 'advances', 'completions'
+    or 'dropoffs') for the screen ``slug``, today unless ``day`` is given.
+    """
+    # stub screens made up on the fly have no row to count against
+    if not slug or not getattr(settings, 'USSD_SCREEN_STATS', True):
+        return
+    day = day or datetime.date.today()
+    if getattr(settings, 'USSD_STATS_SYNC', False):
+        write_counts({(slug, day, outcome):1})
+    else:
+        get_counters().add(slug, outcome, day)
+
+
+def get_counts(day=None):
+    """
+    Returns {slug: {outcome: count}} for ``day`` (today by default), as
+    last flushed.
+    """
+    from .models import ScreenStat
+    counts = {}
+    for slug, outcome, n in ScreenStat.objects.filter(day=day or datetime.date.today()).values_list('screen', 'outcome', 'count'):
+        counts.setdefault(slug, {})[outcome] = n
+    return counts
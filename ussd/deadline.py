@@ -0,0 +1,136 @@
+"""
+Per-hop latency budgets.
+
+Gateways drop the dialog if they don't get an answer within a few seconds.
+When USSD_HOP_DEADLINE is set (in seconds), each hop runs against a
+Deadline: work that isn't needed to work out the next screen (completing
+the session, which writes out its XForm answers) is deferred until after the response has
+been sent, and advance_progress checks the budget between its stages.  If
+less than USSD_HOP_DEADLINE_MARGIN seconds are left before the session has
+committed to its next screen, the hop is abandoned and the subscriber is
+asked to retry, with the session left as it was.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline(object):
+
+    def __init__(self, budget, margin=0.5):
+        self.expires = time.time() + budget
+        self.margin = margin
+        self.abandoned = False
+        self.committed = False
+        self.deferred = []
+        self.lock = threading.Lock()
+
+    def remaining(self):
+        return self.expires - time.time()
+
+    def check(self):
+        if not self.committed and (self.abandoned or self.remaining() < self.margin):
+            raise DeadlineExceeded()
+
+    def commit(self):
+        """
+        Marks the point after which the hop will run to completion, raises
+        DeadlineExceeded if it is already too late (or was abandoned).
+        """
+        self.lock.acquire()
+        try:
+            self.check()
+            self.committed = True
+        finally:
+            self.lock.release()
+
+    def abandon(self):
+        """
+        Gives up on a hop being processed by another thread.  Returns False
+        if that's no longer possible, because the hop has already committed.
+        """
+        self.lock.acquire()
+        try:
+            if not self.committed:
+                self.abandoned = True
+            return self.abandoned
+        finally:
+            self.lock.release()
+
+    def run_deferred(self):
+        deferred, self.deferred = self.deferred, []
+        for fn, args, kwargs in deferred:
+            try:
+                fn(*args, **kwargs)
+            except Exception:
+                logger.exception('Deferred %r failed' % fn)
+
+
+def new_deadline():
+    budget = getattr(settings, 'USSD_HOP_DEADLINE', None)
+    if budget is None:
+        return None
+    return Deadline(budget, getattr(settings, 'USSD_HOP_DEADLINE_MARGIN', 0.5))
+
+
+def current_deadline():
+    return getattr(_local, 'deadline', None)
+
+
+@contextmanager
+def within(deadline):
+    _local.deadline = deadline
+    try:
+        yield
+    finally:
+        _local.deadline = None
+
+
+def check_deadline():
+    deadline = current_deadline()
+    if deadline is not None:
+        deadline.check()
+
+
+def commit_deadline():
+    deadline = current_deadline()
+    if deadline is not None:
+        deadline.commit()
+
+
+def defer(fn, *args, **kwargs):
+    """
+    Runs ``fn`` after the response has been sent if the current hop has a
+    deadline, straight away otherwise.
+    """
+    deadline = current_deadline()
+    if deadline is None:
+        return fn(*args, **kwargs)
+    deadline.deferred.append((fn, args, kwargs))
+
+
+def run_after_response(response, fn):
+    """
+    WSGI servers call close() on the response once it has been sent, so
+    hook ``fn`` in there.  Callers invoking a view directly (tests, the
+    benchmark) need to close() the response themselves.
+    """
+    close = response.close
+    def closer():
+        try:
+            fn()
+        finally:
+            close()
+    response.close = closer
+    return response
@@ -1,7 +1,7 @@
-from .models import Session
+from .connections import resolve_connection
+from .store import get_session_store
 from django import forms
-from rapidsms.models import Connection
-from uganda_common.utils import assign_backend
+from django.conf import settings
 import datetime
 
 class YoForm(forms.Form):
@@ -12,7 +12,8 @@ class YoForm(forms.Form):
     # YYYYMMDD(T)HH:MM:SS
     transactionTime = forms.CharField()
     # The telephone number of the subscriber who is interacting with the USSD
-    # code.
+    # code.  Cleans to its Connection (with USSD_LAZY_MSISDN, responses
+    # within an existing session are left as the raw number, see clean_msisdn).
     msisdn = forms.CharField()
     #This is the number the subscriber dialed. For example, if the subscriber dialed *150#, 
     # 150 is the service code, the max length is 4
@@ -25,9 +26,12 @@ class YoForm(forms.Form):
 
     def clean_msisdn(self):
         cleaned_data = self.cleaned_data
-        identity, backend = assign_backend(cleaned_data['msisdn'])
-        c, created = Connection.objects.get_or_create(identity=identity, backend=backend)
-        return c
+        # an existing session already holds its connection, so with
+        # USSD_LAZY_MSISDN responses are only resolved (in clean) if their
+        # session has to be created
+        if self.data.get('response') == 'true' and getattr(settings, 'USSD_LAZY_MSISDN', False):
+            return cleaned_data['msisdn']
+        return resolve_connection(cleaned_data['msisdn'])
 
     def clean_transactionTime(self):
         cleaned_data = self.cleaned_data
@@ -41,15 +45,24 @@ class YoForm(forms.Form):
 
     def clean(self):
         cleaned_data = self.cleaned_data
+        if self._errors:
+            return cleaned_data
+
         transaction_id = cleaned_data.get('transactionId')
+        service_code = cleaned_data.get('ussdServiceCode')
 
-        try:
-            session = Session.objects.get(transaction_id=transaction_id)
-            cleaned_data['transactionId'] = session
-        except Session.DoesNotExist:
-            session = Session.objects.create(transaction_id=transaction_id, \
-                                                 connection=cleaned_data.get('msisdn'))
-            cleaned_data['transactionId'] = session
+        store = get_session_store()
+        session = None
+        # the first request of a session isn't a response to anything, so
+        # there's no point looking for an existing session
+        if cleaned_data.get('response') != 'false':
+            session = store.get(transaction_id, service_code)
+        if session is None:
+            connection = cleaned_data.get('msisdn')
+            if isinstance(connection, basestring):
+                connection = cleaned_data['msisdn'] = resolve_connection(connection)
+            session = store.create(transaction_id, connection, service_code)
+        cleaned_data['transactionId'] = session
 
         return cleaned_data
 
@@ -0,0 +1,144 @@
+"""
+Per-screen, per-day funnel figures, computed by streaming Navigation rows.
+
+Navigations are read in primary key order, a chunk at a time, and folded
+into counters keyed by (day, screen).  For every navigation the screen
+gets a view; what happened next is worked out from the session's
+following navigation:
+
+* errors: the same screen was shown again (invalid input)
+* advances: the session moved on to another screen, or went back from
+  this one
+* completions, dropoffs, open: it was the session's last navigation, and
+  the session completed, timed out or is still open
+
+Only the sessions seen in the last ``window`` of navigation time are kept
+in memory, so memory use depends on how many sessions run at once, not on
+the number of rows.  The whole state can be saved as a checkpoint and
+resumed from.
+
+These are the same figures Session counts as it goes (see ussd.counters),
+so the ussd_rebuild_stats command can recompute those from here.
+"""
+import datetime
+
+from django.conf import settings
+
+from .models import Navigation
+
+COLUMNS = ('views', 'errors', 'advances', 'completions', 'dropoffs', 'open')
+
+OUTCOMES = {
+    'complete': 'completions',
+    'timeout': 'dropoffs',
+    'open': 'open',
+}
+
+
+class Funnel(object):
+
+    def __init__(self, start=None, end=None, window=3600, using=None):
+        self.start = start
+        self.end = end
+        self.window = datetime.timedelta(seconds=window)
+        self.using = using
+        self.last_pk = 0
+        self.counts = {}
+        # session pk -> (day, slug, date, status, back) of its latest
+        # navigation, back being True if it was answered with the back key
+        self.sessions = {}
+        self.back_key = getattr(settings, 'BACK_KEY', '#')
+
+    def count(self, day, slug, column):
+        try:
+            row = self.counts[(day, slug)]
+        except KeyError:
+            row = self.counts[(day, slug)] = dict((c, 0) for c in COLUMNS)
+        row[column] += 1
+
+    def queryset(self):
+        navigations = Navigation.objects.all()
+        if self.using:
+            navigations = navigations.using(self.using)
+        if self.start:
+            navigations = navigations.filter(date__gte=self.start)
+        if self.end:
+            navigations = navigations.filter(date__lt=self.end)
+        return navigations
+
+    def add(self, session, slug, date, status, response=''):
+        day = date.date().isoformat()
+        self.count(day, slug, 'views')
+        previous = self.sessions.get(session)
+        if previous is not None:
+            # going back from a screen leaves it, even back to itself
+            self.count(previous[0], previous[1], 'errors' if previous[1] == slug and not previous[4] else 'advances')
+        self.sessions[session] = (day, slug, date, status, response.rsplit('_')[0] == self.back_key)
+
+    def close(self, session):
+        day, slug, date, status, back = self.sessions.pop(session)
+        self.count(day, slug, OUTCOMES.get(status, 'open'))
+
+    def expire(self, now):
+        """
+        Closes the sessions that haven't been seen within the window.
+        """
+        for session, (day, slug, date, status, back) in self.sessions.items():
+            if now - date > self.window:
+                self.close(session)
+
+    def run(self, chunk_size=10000, checkpoint=None, every=10):
+        """
+        Reads every remaining navigation, calling ``checkpoint(self)``
+        after every ``every`` chunks and at the end, then closes the
+        sessions still in memory.
+        """
+        navigations = self.queryset().order_by('pk').values_list('pk', 'session', 'screen', 'date', 'session__status', 'response')
+        chunks = 0
+        while True:
+            latest = None
+            rows = 0
+            for pk, session, slug, date, status, response in navigations.filter(pk__gt=self.last_pk)[:chunk_size].iterator():
+                self.add(session, slug, date, status, response)
+                self.last_pk = pk
+                latest = max(latest, date)
+                rows += 1
+            if not rows:
+                break
+            self.expire(latest)
+            chunks += 1
+            if checkpoint and chunks % every == 0:
+                checkpoint(self)
+        if checkpoint:
+            # a later run carries on from here, with sessions still open
+            checkpoint(self)
+        for session in self.sessions.keys():
+            self.close(session)
+
+    def rows(self):
+        for (day, slug), row in sorted(self.counts.items()):
+            views = row['views']
+            yield dict(row,
+                day=day,
+                screen=slug,
+                error_rate=float(row['errors']) / views if views else None,
+                dropoff_rate=float(row['dropoffs']) / views if views else None,
+                completion_rate=float(row['completions']) / views if views else None,
+            )
+
+    def get_state(self):
+        return {
+            'last_pk':self.last_pk,
+            'counts':[[day, slug, row] for (day, slug), row in self.counts.items()],
+            'sessions':[[session, day, slug, date.isoformat(), status, back] for session, (day, slug, date, status, back) in self.sessions.items()],
+        }
+
+    def set_state(self, state):
+        self.last_pk = state['last_pk']
+        self.counts = dict(((day, slug), row) for day, slug, row in state['counts'])
+        self.sessions = {}
+        for entry in state['sessions']:
+            session, day, slug, date, status = entry[:5]
+            date = datetime.datetime.strptime(date.split('.')[0], '%Y-%m-%dT%H:%M:%S')
+            # checkpoints from before back navigations were told apart
+            self.sessions[session] = (day, slug, date, status, len(entry) > 5 and entry[5])
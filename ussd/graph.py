@@ -0,0 +1,427 @@
+"""
+A compiled, read-only copy of the whole Screen tree.
+
+Walking a menu through the ORM costs several queries per hop (the current
+screen, its children, a count to decide whether it is terminal, ...), even
+though the tree itself almost never changes.  The graph below is built once
+per process, along with the text each screen renders to, and is thrown
+away whenever a Screen (or the XFormField a Field is bound to) is saved or
+deleted.  Because those signals are only seen by the process that made the
+change, other processes rebuild their copy after USSD_GRAPH_TTL seconds
+(set it to None to never expire).
+
+The graph can also be written to a JSON artifact (see the ussd_compile_tree
+command).  When USSD_FROZEN_TREE names such a file, the graph is loaded from
+it rather than the database, so a gateway keeps serving menus from that
+snapshot even if the database holding the tree is unavailable.
+
+Artifacts can also be published to the database as TreeVersions (see the
+ussd_publish_tree command).  Once a version is activated, new sessions
+start on it rather than on the Screen tables, and each Session stays on
+the version it started on until it ends, so editing the tree, or
+activating another version, never changes a menu under a subscriber.
+Activating builds the version's graph and renders its screens first, then
+flips the single ActiveTree row; other processes notice the flip within
+USSD_ACTIVE_TREE_TTL seconds (10 by default), and warm the new version
+before they start sessions on it.  Up to USSD_TREE_VERSIONS_CACHED
+versions (5 by default) are kept per process.
+"""
+import copy
+import datetime
+import hashlib
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DatabaseError
+from django.db.models import get_model
+from django.utils import simplejson as json
+
+ARTIFACT_FORMAT = 1
+
+
+class ScreenGraph(object):
+    """
+    Holds the most specific (downcast) instance of every screen, keyed by slug,
+    along with the parent/child structure of the tree.  Instances handed out
+    by screen() are copies, so per-request state (has_errors, error_text)
+    set on them never leaks into the shared graph.
+    """
+
+    def __init__(self, screens):
+        self.screens = {}
+        self.children = {}
+        self.roots = []
+        self.rendered = {}
+        self.compiled = time.time()
+        # set for graphs loaded from an artifact
+        self.version = None
+
+        for screen in screens:
+            # screens handed out keep rendering and navigating in this graph
+            screen._graph = self
+            self.screens[screen.slug] = screen
+
+        ordered = sorted(self.screens.values(), key=lambda s: (s.tree_id, s.lft))
+        for screen in ordered:
+            if screen.parent_id is None:
+                self.roots.append(screen.slug)
+            else:
+                self.children.setdefault(screen.parent_id, []).append(screen)
+
+        self.by_order = {}
+        for parent, children in self.children.items():
+            children.sort(key=lambda s: s.order)
+            orders = {}
+            for child in children:
+                orders.setdefault(child.order, child.slug)
+            self.by_order[parent] = orders
+
+    def __contains__(self, slug):
+        return slug in self.screens
+
+    def screen(self, slug):
+        """
+        Returns a private copy of the typed screen with the given slug,
+        or None if no such screen exists.
+        """
+        try:
+            return copy.copy(self.screens[slug])
+        except KeyError:
+            return None
+
+    def get_children(self, slug):
+        """
+        The (shared, read-only) children of a screen, in menu order.
+        """
+        return self.children.get(slug, [])
+
+    def child(self, slug, order):
+        """
+        The child of a screen displayed at position ``order``, or None.
+        """
+        try:
+            return self.screen(self.by_order[slug][order])
+        except KeyError:
+            return None
+
+    def next(self, slug):
+        """
+        The screen a Question points to via ``next``, or None.
+        """
+        next_id = getattr(self.screens.get(slug), 'next_id', None)
+        if next_id is None:
+            return None
+        return self.screen(next_id)
+
+    def is_leaf(self, slug):
+        return slug not in self.children
+
+    def is_cacheable(self, screen):
+        return bool(type(screen).__dict__.get('cache_text')) and screen.slug in self.screens
+
+    def is_canonical(self, screen):
+        """
+        True if rendering a fresh copy of this screen gives the same text,
+        i.e. its text needn't be kept around for backwards navigation.
+        """
+        return self.is_cacheable(screen) and not screen.has_errors
+
+    def render(self, screen):
+        """
+        Returns ``screen.render()``, memoized per slug, error state and
+        BACK_KEY.  Only classes that declare ``cache_text = True`` themselves
+        are memoized: a subclass that renders state-driven text doesn't
+        inherit the cache by accident.
+        """
+        if not self.is_cacheable(screen):
+            return screen.render()
+
+        key = (screen.slug, screen.has_errors, getattr(settings, 'BACK_KEY', '#'))
+        if screen.has_errors:
+            key += (getattr(screen, 'error_label', ''), screen.error_text)
+        try:
+            return self.rendered[key]
+        except KeyError:
+            text = self.rendered[key] = screen.render()
+            return text
+
+
+_graph = None
+_lock = threading.Lock()
+
+# version -> ScreenGraph, and (version, time looked up) of the active one
+_versions = {}
+_versions_lock = threading.Lock()
+_active = None
+
+
+def _concrete_subclasses(model):
+    for subclass in model.__subclasses__():
+        if not subclass._meta.abstract and not subclass._meta.proxy:
+            yield subclass
+        for s in _concrete_subclasses(subclass):
+            yield s
+
+
+def load_typed(slugs=None):
+    """
+    Loads screens from the database (all of them, or those with the given
+    slugs) with one query per concrete subclass, and returns them keyed by
+    slug, each as its most specific type.
+    """
+    from .models import Screen, Field
+
+    models = [Screen] + list(set(_concrete_subclasses(Screen)))
+    # least specific first, so subclass rows overwrite their parents'
+    models.sort(key=lambda m: len(m.__mro__))
+
+    typed = {}
+    for model in models:
+        queryset = model.objects.all()
+        if slugs is not None:
+            queryset = queryset.filter(pk__in=slugs)
+        if issubclass(model, Field):
+            queryset = queryset.select_related('field__xform')
+        for screen in queryset:
+            typed[screen.slug] = screen
+    return typed
+
+
+def load_screens():
+    return ScreenGraph(load_typed().values())
+
+
+def _dump_instance(obj):
+    return {
+        'model':'%s.%s' % (obj._meta.app_label, obj._meta.object_name.lower()),
+        'fields':dict((f.attname, getattr(obj, f.attname)) for f in obj._meta.fields),
+    }
+
+
+def _load_instance(data):
+    model = get_model(*data['model'].split('.'))
+    values = {}
+    for f in model._meta.fields:
+        if f.attname in data['fields']:
+            values[str(f.attname)] = f.to_python(data['fields'][f.attname])
+    return model(**values)
+
+
+def dump_graph(graph):
+    """
+    Returns the graph as a JSON-serializable dict: every screen's fields,
+    and for Fields, the XFormField and XForm they are bound to.  The
+    version is a hash of the screens, so identical trees get the same one.
+    """
+    from .models import Field
+
+    screens = []
+    for slug in sorted(graph.screens):
+        screen = graph.screens[slug]
+        data = _dump_instance(screen)
+        if isinstance(screen, Field):
+            data['field'] = _dump_instance(screen.field)
+            data['field']['xform'] = _dump_instance(screen.field.xform)
+        screens.append(data)
+    screens = json.loads(json.dumps(screens, cls=DjangoJSONEncoder))
+    return {
+        'format':ARTIFACT_FORMAT,
+        'version':hashlib.sha1(json.dumps(screens, sort_keys=True)).hexdigest(),
+        'compiled':datetime.datetime.now().isoformat(),
+        'screens':screens,
+    }
+
+
+def load_graph(data):
+    """
+    Builds a ScreenGraph from dump_graph's output, without touching the
+    database.
+    """
+    from .models import Field
+
+    if data.get('format') != ARTIFACT_FORMAT:
+        raise ValueError('Unsupported screen tree format %r' % data.get('format'))
+    screens = []
+    for screen_data in data['screens']:
+        screen = _load_instance(screen_data)
+        if 'field' in screen_data:
+            field = _load_instance(screen_data['field'])
+            setattr(field, type(field)._meta.get_field('xform').get_cache_name(), _load_instance(screen_data['field']['xform']))
+            setattr(screen, Field._meta.get_field('field').get_cache_name(), field)
+        screens.append(screen)
+    graph = ScreenGraph(screens)
+    graph.version = data['version']
+    return graph
+
+
+def read_graph(path):
+    try:
+        f = open(path)
+        try:
+            return load_graph(json.load(f))
+        finally:
+            f.close()
+    except (IOError, ValueError), e:
+        raise ImproperlyConfigured('Error loading USSD_FROZEN_TREE %s: %s' % (path, e))
+
+
+def write_graph(graph, path):
+    """
+    Writes the graph's artifact to ``path``, replacing any previous one
+    in a single rename.
+    """
+    data = dump_graph(graph)
+    f = open(path + '.tmp', 'w')
+    try:
+        json.dump(data, f)
+    finally:
+        f.close()
+    os.rename(path + '.tmp', path)
+    return data
+
+
+def compile_graph():
+    frozen = getattr(settings, 'USSD_FROZEN_TREE', None)
+    if frozen:
+        return read_graph(frozen)
+    return load_screens()
+
+
+def warm_graph(graph):
+    """
+    Renders every screen whose text the graph memoizes, so the first
+    sessions on it don't pay for that.
+    """
+    for slug in graph.screens:
+        screen = graph.screen(slug)
+        if graph.is_cacheable(screen):
+            graph.render(screen)
+    return graph
+
+
+def get_version_graph(version):
+    """
+    The graph of a published TreeVersion, loaded and warmed the first time
+    it is asked for.
+    """
+    graph = _versions.get(version)
+    if graph is None:
+        from .models import TreeVersion
+        _versions_lock.acquire()
+        try:
+            graph = _versions.get(version)
+            if graph is None:
+                artifact = TreeVersion.objects.filter(pk=version).values_list('artifact', flat=True)
+                if not artifact:
+                    raise ImproperlyConfigured("Screen tree version '%s' doesn't exist" % version)
+                graph = warm_graph(load_graph(json.loads(artifact[0])))
+                active = _active and _active[0]
+                while _versions and len(_versions) >= getattr(settings, 'USSD_TREE_VERSIONS_CACHED', 5):
+                    # sessions pinned to a dropped version load it again
+                    oldest = min((g.compiled, v) for v, g in _versions.items() if v != active or len(_versions) == 1)
+                    del _versions[oldest[1]]
+                _versions[version] = graph
+        finally:
+            _versions_lock.release()
+    return graph
+
+
+def get_active_version():
+    """
+    The version new sessions start on, or None to use the Screen tables.
+    """
+    global _active
+    active = _active
+    if active is None or time.time() - active[1] > getattr(settings, 'USSD_ACTIVE_TREE_TTL', 10):
+        from .models import ActiveTree
+        try:
+            version = ActiveTree.objects.filter(pk=1).values_list('version', flat=True)
+            version = version[0] if version else None
+        except DatabaseError:
+            if active is None:
+                raise
+            # keep serving the version we know about
+            version = active[0]
+        if version:
+            # warm the new version before any session starts on it
+            get_version_graph(version)
+        _active = active = (version, time.time())
+    return active[0]
+
+
+def publish_version(graph=None):
+    """
+    Stores a snapshot of the graph (compiled from the Screen tables by
+    default) as a TreeVersion, without activating it.  Returns its version.
+    """
+    from .models import TreeVersion
+    data = dump_graph(graph or load_screens())
+    TreeVersion.objects.get_or_create(version=data['version'], defaults={'artifact':json.dumps(data)})
+    return data['version']
+
+
+def activate_version(version):
+    """
+    Points new sessions at a published version, once its graph is built
+    and warmed.  Sessions already running stay on their own version.
+    """
+    global _active
+    from .models import ActiveTree
+    get_version_graph(version)
+    if not ActiveTree.objects.filter(pk=1).update(version=version):
+        ActiveTree.objects.create(pk=1, version_id=version)
+    _active = (version, time.time())
+
+
+def session_version():
+    """
+    The version a session starting now is pinned to, or None.  A frozen
+    tree takes precedence over the database's versions, and setting
+    USSD_TREE_VERSIONS = False ignores them.
+    """
+    if getattr(settings, 'USSD_FROZEN_TREE', None) or not getattr(settings, 'USSD_TREE_VERSIONS', True):
+        return None
+    return get_active_version()
+
+
+def get_graph():
+    """
+    The graph new sessions use: the frozen artifact if USSD_FROZEN_TREE is
+    set, otherwise the active TreeVersion, if any, otherwise the Screen
+    tables.
+    """
+    version = session_version()
+    if version:
+        return get_version_graph(version)
+    return get_table_graph()
+
+
+def get_table_graph():
+    """
+    The graph of the frozen artifact if USSD_FROZEN_TREE is set, otherwise
+    of the Screen tables, whichever version is active: sessions that aren't
+    pinned to a version use it.
+    """
+    global _graph
+    graph = _graph
+    ttl = getattr(settings, 'USSD_GRAPH_TTL', 300)
+    if graph is None or (ttl is not None and time.time() - graph.compiled > ttl):
+        _lock.acquire()
+        try:
+            if _graph is graph:
+                _graph = compile_graph()
+            graph = _graph
+        finally:
+            _lock.release()
+    return graph
+
+
+def invalidate_graph(**kwargs):
+    global _graph, _active
+    _graph = None
+    # look the active version up again too, on the next hop
+    _active = None
@@ -0,0 +1,245 @@
+"""
+Per-hop instrumentation of the ussd gateway view.
+
+With USSD_INSTRUMENTATION = True, every hop through the view records its
+total time, the number of queries it ran and the time spent in SQL, and
+the time spent in each of its stages ('clean', 'advance_progress',
+'pre_transition', 'complete', 'store', 'render').  Each hop is logged as a single
+key=value line on the 'ussd.instrumentation' logger, and kept in a bounded
+in-process sample per screen type, summarized by get_stats().
+
+Work a hop defers until after its response (see ussd.deadline), or hands
+to a background thread, is recorded against the hop too, through
+carried(); the hop is logged once that work has run as well.  Its total
+is still the time taken to respond.
+"""
+import logging
+import math
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class Hop(object):
+
+    def __init__(self):
+        self.timings = {}
+        self.screen = ''
+        self.screen_type = ''
+        self.queries = 0
+        self.sql_time = 0.0
+        self.total = 0.0
+        # work still to be recorded against the hop, see carried()
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def hold(self):
+        self.lock.acquire()
+        try:
+            self.pending += 1
+        finally:
+            self.lock.release()
+
+    def release(self):
+        """
+        Records the hop once all the work holding it has finished.
+        """
+        self.lock.acquire()
+        try:
+            self.pending -= 1
+            done = not self.pending
+        finally:
+            self.lock.release()
+        if done:
+            stats.add(self)
+            logger.info('hop %s' % self)
+
+    def as_dict(self):
+        d = {
+            'screen':self.screen,
+            'screen_type':self.screen_type,
+            'total_ms':self.total * 1000,
+            'queries':self.queries,
+            'sql_ms':self.sql_time * 1000,
+        }
+        for name, elapsed in self.timings.items():
+            d['%s_ms' % name] = elapsed * 1000
+        return d
+
+    def __str__(self):
+        d = self.as_dict()
+        line = ['screen=%s' % d.pop('screen'), 'screen_type=%s' % d.pop('screen_type'), 'queries=%d' % d.pop('queries')]
+        line.extend('%s=%.1f' % (k, v) for k, v in sorted(d.items()))
+        return ' '.join(line)
+
+
+def current_hop():
+    return getattr(_local, 'hop', None)
+
+
+@contextmanager
+def timed(name):
+    """
+    Adds the time spent in the block to the current hop's timings, if
+    the hop is being instrumented.
+    """
+    hop = current_hop()
+    if hop is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        hop.timings[name] = hop.timings.get(name, 0) + time.time() - start
+
+
+def record_screen(screen):
+    hop = current_hop()
+    if hop is not None:
+        hop.screen = screen.pk or ''
+        hop.screen_type = type(screen).__name__
+
+
+class HopStats(object):
+    """
+    Keeps the last ``size`` hops per screen type, for percentiles.
+    """
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def add(self, hop):
+        self.lock.acquire()
+        try:
+            self.samples.setdefault(hop.screen_type, deque(maxlen=self.size)).append(hop.as_dict())
+        finally:
+            self.lock.release()
+
+    def summary(self):
+        self.lock.acquire()
+        try:
+            samples = dict((k, list(v)) for k, v in self.samples.items())
+        finally:
+            self.lock.release()
+
+        toret = {}
+        for screen_type, hops in samples.items():
+            summary = {'count':len(hops)}
+            for key in ('total_ms', 'sql_ms', 'queries'):
+                values = sorted(h[key] for h in hops)
+                for p in (50, 95, 99):
+                    summary['%s_p%d' % (key, p)] = percentile(values, p)
+            toret[screen_type] = summary
+        return toret
+
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.samples = {}
+        finally:
+            self.lock.release()
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    if not values:
+        return None
+    index = int(math.ceil(p / 100.0 * len(values))) - 1
+    return values[max(0, index)]
+
+
+stats = HopStats(getattr(settings, 'USSD_INSTRUMENTATION_SAMPLES', 1000))
+
+
+def get_stats():
+    return stats.summary()
+
+
+@contextmanager
+def bound(hop):
+    """
+    Records the block's stage timings and queries against ``hop``.  Also
+    used to carry a hop over to the thread that does its work.
+    """
+    if hop is None:
+        yield
+        return
+    previous = current_hop()
+    _local.hop = hop
+    use_debug_cursor = connection.use_debug_cursor
+    recording = use_debug_cursor or settings.DEBUG
+    connection.use_debug_cursor = True
+    first_query = len(connection.queries)
+    try:
+        yield
+    finally:
+        queries = connection.queries[first_query:]
+        hop.lock.acquire()
+        try:
+            hop.queries += len(queries)
+            hop.sql_time += sum(float(q['time']) for q in queries)
+        finally:
+            hop.lock.release()
+        if not recording:
+            # nothing resets the log outside of requests (e.g. in pool threads)
+            del connection.queries[first_query:]
+        connection.use_debug_cursor = use_debug_cursor
+        _local.hop = previous
+
+
+def carried(fn):
+    """
+    Wraps ``fn``, to be run later or in another thread, so that its
+    timings and queries are recorded against the current hop, which isn't
+    logged until it has run.
+    """
+    hop = current_hop()
+    if hop is None:
+        return fn
+    hop.hold()
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        try:
+            if current_hop() is hop:
+                # run inline, already being recorded
+                return fn(*args, **kwargs)
+            with bound(hop):
+                return fn(*args, **kwargs)
+        finally:
+            hop.release()
+    return wrapper
+
+
+def instrument(view):
+    """
+    Wraps a gateway view so that each request is recorded as a Hop.
+    """
+    @wraps(view)
+    def wrapper(req, *args, **kwargs):
+        if not getattr(settings, 'USSD_INSTRUMENTATION', False):
+            return view(req, *args, **kwargs)
+
+        hop = Hop()
+        hop.hold()
+        start = time.time()
+        try:
+            with bound(hop):
+                return view(req, *args, **kwargs)
+        finally:
+            hop.total = time.time() - start
+            hop.release()
+    return wrapper
@@ -0,0 +1,26 @@
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+
+from ussd.graph import activate_version, get_active_version
+from ussd.models import TreeVersion
+
+
+class Command(BaseCommand):
+    help = """Starts new sessions on a published TreeVersion (e.g. to roll back to
+an earlier one), or lists the published versions if none is given.  The
+version's screens are compiled and rendered before it is switched to."""
+    args = '[<version>]'
+
+    def handle(self, *args, **options):
+        if len(args) > 1:
+            raise CommandError('Usage: ussd_activate_tree %s' % self.args)
+        if not args:
+            active = get_active_version()
+            for version, created in TreeVersion.objects.order_by('-created').values_list('version', 'created'):
+                self.stdout.write("%s %s %s\n" % (version == active and '*' or ' ', version, created.strftime('%Y-%m-%d %H:%M:%S')))
+            return
+        try:
+            activate_version(args[0])
+        except ImproperlyConfigured, e:
+            raise CommandError(str(e))
+        self.stdout.write("Activated version %s\n" % args[0])
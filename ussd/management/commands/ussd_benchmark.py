@@ -0,0 +1,51 @@
+import random
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.utils import simplejson as json
+
+from ussd.benchmark import build_tree, destroy_tree, overridden, script_session, run
+
+
+class Command(BaseCommand):
+    help = """Builds a synthetic Screen tree, drives scripted sessions through the
+ussd view and reports hops per second, latency percentiles and queries per hop.
+Run it against a scratch database: the tree and its sessions are created for
+real (and removed afterwards, unless --keep is given)."""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--depth', type='int', default=3, help='Levels of menus in the tree'),
+        make_option('--breadth', type='int', default=4, help='Children per menu'),
+        make_option('--mix', default='1,1,1', help='Proportions of Menu,Question,Field leaves'),
+        make_option('--sessions', type='int', default=100, help='Number of scripted sessions'),
+        make_option('--invalid', type='float', default=0.0, help='Probability of invalid input per hop'),
+        make_option('--back', type='float', default=0.0, help='Probability of a back press per menu'),
+        make_option('--seed', type='int', default=0),
+        make_option('--prefix', default='bench', help='Slug prefix for the generated screens and sessions'),
+        make_option('--output', help='Write the results as JSON to this file'),
+        make_option('--keep', action='store_true', default=False, help="Don't remove the tree afterwards"),
+    )
+
+    def handle(self, **options):
+        prefix = options['prefix']
+        mix = [int(m) for m in options['mix'].split(',')]
+        root = build_tree(prefix, options['depth'], options['breadth'], mix)
+
+        try:
+            with overridden(INITIAL_USSD_SCREEN=root.slug, USSD_TREE_VERSIONS=False):
+                rng = random.Random(options['seed'])
+                scripts = [script_session(root.slug, rng, options['invalid'], options['back']) for i in range(options['sessions'])]
+                results = run(scripts, prefix)
+        finally:
+            if not options['keep']:
+                destroy_tree(prefix)
+
+        results['config'] = dict((k, options[k]) for k in ('depth', 'breadth', 'mix', 'sessions', 'invalid', 'back', 'seed'))
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            f = open(options['output'], 'w')
+            try:
+                f.write(output)
+            finally:
+                f.close()
+        self.stdout.write(output + "\n")
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ussd.graph import load_screens, write_graph
+
+
+class Command(BaseCommand):
+    help = """Writes the whole Screen tree, with Menu ordering, Question.next links,
+Field to XFormField bindings and StubScreen texts, to a versioned JSON
+artifact.  Point USSD_FROZEN_TREE at the file to have gateways serve the
+tree from it instead of the database."""
+    args = '<path>'
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Usage: ussd_compile_tree %s' % self.args)
+        graph = load_screens()
+        if not graph.screens:
+            raise CommandError('There are no screens to compile')
+        data = write_graph(graph, args[0])
+        self.stdout.write("Wrote %d screens to %s, version %s\n" % (len(data['screens']), args[0], data['version']))
@@ -0,0 +1,47 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import simplejson as json
+
+from ussd.trees import export_trees
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+class Command(BaseCommand):
+    help = """Exports screen trees (those under the given root slugs, or all of
+them) as JSON or YAML, for ussd_import_tree."""
+    args = '[root slug ...]'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', default='json', help='json or yaml'),
+        make_option('--output', help='Write the export to this file rather than stdout'),
+    )
+
+    def handle(self, *roots, **options):
+        if options['format'] == 'yaml' and yaml is None:
+            raise CommandError('YAML exports need PyYAML installed')
+        if options['format'] not in ('json', 'yaml'):
+            raise CommandError("Unknown format '%s', use json or yaml" % options['format'])
+
+        data = export_trees(roots)
+        if not data['screens']:
+            raise CommandError('There are no screens to export')
+        if options['format'] == 'yaml':
+            # go through JSON, so values are plain types YAML can dump safely
+            output = yaml.safe_dump(json.loads(json.dumps(data, cls=DjangoJSONEncoder)), default_flow_style=False)
+        else:
+            output = json.dumps(data, cls=DjangoJSONEncoder, indent=2) + "\n"
+
+        if options['output']:
+            f = open(options['output'], 'w')
+            try:
+                f.write(output)
+            finally:
+                f.close()
+        else:
+            self.stdout.write(output)
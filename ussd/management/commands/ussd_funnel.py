@@ -0,0 +1,83 @@
+import csv
+import datetime
+import os
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import simplejson as json
+
+from ussd.funnel import Funnel, COLUMNS
+
+RATES = ('error_rate', 'dropoff_rate', 'completion_rate')
+
+
+class Command(BaseCommand):
+    help = """Reports views, errors, advances, completions and drop-offs per screen
+per day, streaming Navigation rows in primary key chunks.  With --checkpoint,
+progress is saved to that file as it goes, and an interrupted (or later) run
+picks up where it left off.  Point --database at a reporting replica."""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--from', dest='start', help='Only navigations on or after this date (YYYY-MM-DD)'),
+        make_option('--to', dest='end', help='Only navigations before this date (YYYY-MM-DD)'),
+        make_option('--format', default='csv', help='csv or json'),
+        make_option('--output', help='Write the report to this file rather than stdout'),
+        make_option('--checkpoint', help='Save progress to, and resume from, this file'),
+        make_option('--chunk', type='int', default=10000, help='Navigations read per query'),
+        make_option('--window', type='int', default=3600, help='Seconds after which a session with no new navigations is closed'),
+        make_option('--database', default=None, help='Database alias to read from'),
+    )
+
+    def handle(self, **options):
+        if options['format'] not in ('csv', 'json'):
+            raise CommandError("Unknown format '%s', use csv or json" % options['format'])
+        start, end = [self.parse_date(options[k]) for k in ('start', 'end')]
+        funnel = Funnel(start, end, options['window'], options['database'])
+
+        path = options['checkpoint']
+        checkpoint = None
+        if path:
+            if os.path.exists(path):
+                f = open(path)
+                try:
+                    state = json.load(f)
+                finally:
+                    f.close()
+                if state.get('from') != options['start'] or state.get('to') != options['end']:
+                    raise CommandError('%s was saved with different dates' % path)
+                funnel.set_state(state)
+
+            def checkpoint(funnel):
+                state = funnel.get_state()
+                state['from'] = options['start']
+                state['to'] = options['end']
+                # write then rename, so an interrupted write can't lose the checkpoint
+                f = open(path + '.tmp', 'w')
+                try:
+                    json.dump(state, f)
+                finally:
+                    f.close()
+                os.rename(path + '.tmp', path)
+
+        funnel.run(options['chunk'], checkpoint)
+
+        out = options['output'] and open(options['output'], 'w') or self.stdout
+        try:
+            if options['format'] == 'json':
+                out.write(json.dumps(list(funnel.rows()), indent=2) + "\n")
+            else:
+                writer = csv.DictWriter(out, ('day', 'screen') + COLUMNS + RATES)
+                writer.writerow(dict((c, c) for c in writer.fieldnames))
+                for row in funnel.rows():
+                    writer.writerow(row)
+        finally:
+            if options['output']:
+                out.close()
+
+    def parse_date(self, value):
+        if not value:
+            return None
+        try:
+            return datetime.datetime.strptime(value, '%Y-%m-%d')
+        except ValueError:
+            raise CommandError("Invalid date '%s', use YYYY-MM-DD" % value)
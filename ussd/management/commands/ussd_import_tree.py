@@ -0,0 +1,50 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import simplejson as json
+
+from ussd.trees import import_trees, TreeError
+
+try:
+    import yaml
+    PARSE_ERRORS = (ValueError, yaml.YAMLError)
+except ImportError:
+    yaml = None
+    PARSE_ERRORS = (ValueError,)
+
+
+class Command(BaseCommand):
+    help = """Imports screen trees written by ussd_export_tree, as new trees, with
+a single bulk insert per table.  Nothing is imported if the file doesn't
+describe valid trees, or any of its slugs are already taken."""
+    args = '<path>'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', default=None, help='json or yaml (by default, guessed from the file name)'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Usage: ussd_import_tree %s' % self.args)
+        path = args[0]
+        format = options['format'] or (path.endswith(('.yaml', '.yml')) and 'yaml' or 'json')
+        if format == 'yaml' and yaml is None:
+            raise CommandError('YAML imports need PyYAML installed')
+
+        f = open(path)
+        try:
+            try:
+                if format == 'yaml':
+                    data = yaml.safe_load(f)
+                else:
+                    data = json.load(f)
+            except PARSE_ERRORS, e:
+                raise CommandError('Could not read %s: %s' % (path, e))
+        finally:
+            f.close()
+
+        try:
+            imported = import_trees(data)
+        except TreeError, e:
+            raise CommandError(str(e))
+        self.stdout.write("Imported %d screens\n" % imported)
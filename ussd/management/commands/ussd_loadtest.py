@@ -0,0 +1,196 @@
+import random
+import threading
+import time
+import urllib
+import urllib2
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import reverse
+from django.test.client import RequestFactory
+from django.utils import simplejson as json
+
+from rapidsms.models import Connection
+from rapidsms_xforms.models import XFormSubmission
+
+from ussd.benchmark import script_session, post_hop, summarize
+from ussd.graph import get_graph
+from ussd.models import Session
+from ussd.routing import route
+from ussd.store import get_session_store
+from ussd.views import ussd
+
+
+class Command(BaseCommand):
+    help = """Simulates the Yo! gateway against the live Screen tree: opens
+--concurrency transactions at a time, with think times between hops, random
+menu choices, invalid input and back presses, and reports throughput, error
+rate and latency percentiles.  Hops are POSTed to --url, or passed to the
+ussd view in-process if no url is given; either way the sessions are real.
+Subscribers are numbered from --msisdn-prefix, by default 2560: no national
+number starts with 0, so ussd_complete handlers never reach a real phone.
+Prefixes outside that range are refused unless --force is given.
+Afterwards the run's sessions and submissions are deleted from the
+database in settings (the gateway's, with --url), along with the
+connections the run created, unless --keep is given.  Connections that
+existed before the run are left alone.  With --url and a gateway keeping
+sessions in a cache or memory store, transactions still open when the run
+ends are only written out by the gateway once they time out, after the
+cleanup, so their navigations are left behind."""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--url', help='Full URL of the ussd-gateway view to POST to'),
+        make_option('--sessions', type='int', default=100, help='Total number of transactions'),
+        make_option('--concurrency', type='int', default=10, help='Transactions open at the same time'),
+        make_option('--think', default='500,3000', help='Min,max think time between hops in milliseconds'),
+        make_option('--invalid', type='float', default=0.05, help='Probability of invalid input per hop'),
+        make_option('--back', type='float', default=0.05, help='Probability of a back press per menu'),
+        make_option('--seed', type='int', default=None),
+        make_option('--prefix', default='load', help='Prefix for the generated transaction ids'),
+        make_option('--msisdn-prefix', dest='msisdn_prefix', default='2560', help='Prefix of the generated subscriber numbers'),
+        make_option('--output', help='Write the results as JSON to this file'),
+        make_option('--keep', action='store_true', default=False, help="Don't delete the run's sessions and connections"),
+        make_option('--force', action='store_true', default=False, help='Allow a --msisdn-prefix of allocated numbers'),
+    )
+
+    def handle(self, **options):
+        unallocated = '%s0' % getattr(settings, 'COUNTRY_CALLING_CODE', '256')
+        if not options['msisdn_prefix'].startswith(unallocated) and not options['force']:
+            raise CommandError("--msisdn-prefix %s isn't in the unallocated range %s, use --force to run against real subscribers' numbers"
+                               % (options['msisdn_prefix'], unallocated))
+        rng = random.Random(options['seed'])
+        think = [int(t) / 1000.0 for t in options['think'].split(',')]
+        graph = get_graph()
+        root = getattr(settings, 'INITIAL_USSD_SCREEN', None) or graph.roots[0]
+        if callable(root):
+            root = root()
+        root = getattr(root, 'slug', root)
+        if root not in graph:
+            raise CommandError("No screen with slug '%s'" % root)
+
+        scripts = [script_session(root, rng, options['invalid'], options['back']) for i in range(options['sessions'])]
+        # use a run-specific prefix, so transaction ids never clash with an earlier run
+        prefix = '%s%d-' % (options['prefix'], int(time.time()))
+        if options['url']:
+            send = self.http_sender(options['url'])
+        else:
+            send = self.view_sender()
+
+        pending = list(enumerate(scripts))
+        latencies = []
+        errors = []
+        started = []
+        # identities of the connections this run created
+        created = set()
+        digits = 12 - len(options['msisdn_prefix'])
+        lock = threading.Lock()
+
+        def worker(seed):
+            worker_rng = random.Random(seed)
+            while True:
+                lock.acquire()
+                try:
+                    if not pending:
+                        return
+                    i, script = pending.pop()
+                finally:
+                    lock.release()
+                transaction_id = '%s%d' % (prefix, i)
+                msisdn = '%s%0*d' % (options['msisdn_prefix'], digits, worker_rng.randint(0, 10 ** digits - 1))
+                identity = route(msisdn)[0]
+                new = not Connection.objects.filter(identity=identity).exists()
+                lock.acquire()
+                try:
+                    started.append(transaction_id)
+                    if new:
+                        created.add(identity)
+                finally:
+                    lock.release()
+                for hop, input in enumerate(script):
+                    if hop:
+                        time.sleep(worker_rng.uniform(*think))
+                    start = time.time()
+                    try:
+                        ok = send(transaction_id, input, hop == 0, msisdn)
+                    except Exception:
+                        ok = False
+                    elapsed = (time.time() - start) * 1000
+                    lock.acquire()
+                    try:
+                        latencies.append(elapsed)
+                        if not ok:
+                            errors.append(transaction_id)
+                    finally:
+                        lock.release()
+                    if not ok:
+                        # the gateway would have dropped the dialog
+                        break
+
+        threads = [threading.Thread(target=worker, args=(rng.random(),)) for i in range(options['concurrency'])]
+        start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - start
+        if not options['keep']:
+            if not options['url']:
+                self.flush(started)
+            self.cleanup(prefix, created)
+
+        results = summarize(latencies, [], elapsed,
+            sessions=len(scripts),
+            errors=len(errors),
+            error_rate=float(len(errors)) / len(latencies) if latencies else None,
+            concurrency=options['concurrency'],
+            think_ms=options['think'],
+        )
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            f = open(options['output'], 'w')
+            try:
+                f.write(output)
+            finally:
+                f.close()
+        self.stdout.write(output + "\n")
+
+    def flush(self, transaction_ids):
+        """
+        Writes out the run's sessions still open in a write-behind session
+        store, so the cleanup deletes them all.
+        """
+        store = get_session_store()
+        if not store.write_behind:
+            return
+        for transaction_id in transaction_ids:
+            session = store.load(transaction_id, '300')
+            if session is not None:
+                store.finish(session)
+
+    def cleanup(self, prefix, identities):
+        XFormSubmission.objects.filter(session__transaction_id__startswith=prefix).delete()
+        Session.objects.filter(transaction_id__startswith=prefix).delete()
+        Connection.objects.filter(identity__in=identities).delete()
+
+    def http_sender(self, url):
+        def send(transaction_id, input, first, msisdn):
+            data = urllib.urlencode({
+                'transactionId':transaction_id,
+                'transactionTime':time.strftime('%Y%m%dT%H:%M:%S'),
+                'msisdn':msisdn,
+                'ussdServiceCode':'300',
+                'ussdRequestString':input,
+                'response':'false' if first else 'true',
+            })
+            response = urllib2.urlopen(url, data)
+            return response.getcode() == 200 and response.read().startswith('responseString=')
+        return send
+
+    def view_sender(self):
+        factory = RequestFactory()
+        url = reverse('ussd-gateway')
+        def send(transaction_id, input, first, msisdn):
+            response = post_hop(ussd, factory, url, transaction_id, input, first, msisdn)
+            return response.status_code == 200 and response.content.startswith('responseString=')
+        return send
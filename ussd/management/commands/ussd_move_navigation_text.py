@@ -0,0 +1,58 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from ussd.models import Navigation, save_texts
+
+
+class Command(BaseCommand):
+    help = """Moves the texts of navigations written before migration 0009 from
+the old ussd_navigation.text column into NavigationText, --chunk rows per
+transaction, so the table is never locked for long.  Run it between
+migrations 0009 and 0010 (0010 refuses to drop the column until it has
+finished), while the gateway keeps running.  Navigations already moved are
+skipped, so an interrupted run can just be started again, or resumed with
+--after the last pk it printed."""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk', type='int', default=5000, help='Navigations moved per transaction'),
+        make_option('--after', type='int', default=0, help='Only navigations with a greater pk'),
+    )
+
+    def handle(self, **options):
+        last_pk = options['after']
+        moved = 0
+        while True:
+            chunk = self.move(last_pk, options['chunk'])
+            if not chunk:
+                break
+            moved += chunk[1]
+            last_pk = chunk[0]
+            self.stdout.write("Moved %d navigations, up to pk %d\n" % (moved, last_pk))
+        self.stdout.write("Done, moved %d navigations\n" % moved)
+
+    @transaction.commit_on_success
+    def move(self, last_pk, chunk_size):
+        """
+        Moves the texts of the next chunk of navigations after ``last_pk``,
+        returns the last pk moved and how many, or None when done.
+        """
+        cursor = connection.cursor()
+        cursor.execute('SELECT id, text FROM %s WHERE id > %%s AND content_id IS NULL AND text IS NOT NULL ORDER BY id LIMIT %%s'
+                       % connection.ops.quote_name(Navigation._meta.db_table), [last_pk, chunk_size])
+        rows = cursor.fetchall()
+        if not rows:
+            return None
+
+        navigations = []
+        by_hash = {}
+        for pk, text in rows:
+            nav = Navigation(id=pk)
+            nav.text = text
+            navigations.append(nav)
+            by_hash.setdefault(nav.content_id, []).append(pk)
+        save_texts(navigations)
+        for hash, pks in by_hash.items():
+            Navigation.objects.filter(pk__in=pks).update(content=hash)
+        return rows[-1][0], len(rows)
@@ -0,0 +1,29 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ussd.graph import load_screens, read_graph, publish_version, activate_version
+
+
+class Command(BaseCommand):
+    help = """Publishes the Screen tree (or a ussd_compile_tree artifact) as a
+TreeVersion, ready to be activated.  Publishing the same tree twice gives
+the same version.  With --activate, new sessions start on it straight away;
+sessions already running stay on the version they started on."""
+    args = '[<artifact>]'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--activate', action='store_true', default=False, help='Activate the version once published'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) > 1:
+            raise CommandError('Usage: ussd_publish_tree %s' % self.args)
+        graph = read_graph(args[0]) if args else load_screens()
+        if not graph.screens:
+            raise CommandError('There are no screens to publish')
+        version = publish_version(graph)
+        self.stdout.write("Published %d screens as version %s\n" % (len(graph.screens), version))
+        if options['activate']:
+            activate_version(version)
+            self.stdout.write("Activated version %s\n" % version)
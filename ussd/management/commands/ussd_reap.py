@@ -0,0 +1,44 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ussd.reaper import reap_sessions, purge_navigations
+
+POLICIES = ('discard', 'keep', 'finalize')
+
+
+class Command(BaseCommand):
+    help = """Times out sessions the gateway abandoned, firing ussd_timeout for
+each, and optionally deletes the navigations of closed sessions after
+--purge-after days.  Safe to run from cron: work is done in small batches,
+each committed on its own."""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--timeout', type='int', default=None, help='Seconds a session must have been idle (default USSD_REAP_TIMEOUT, or 3600)'),
+        make_option('--policy', default=None, help='What to do with the answers of timed out sessions: %s (default USSD_TIMEOUT_POLICY, or discard)' % ', '.join(POLICIES)),
+        make_option('--purge-after', type='int', default=None, help='Delete the navigations of sessions closed and idle for this many days'),
+        make_option('--archive', help='Append purged navigations to this file, as JSON lines'),
+        make_option('--batch', type='int', default=500, help='Sessions fetched per batch'),
+        make_option('--chunk', type='int', default=1000, help='Navigations deleted per transaction'),
+    )
+
+    def handle(self, **options):
+        timeout = options['timeout'] or getattr(settings, 'USSD_REAP_TIMEOUT', 3600)
+        policy = options['policy'] or getattr(settings, 'USSD_TIMEOUT_POLICY', 'discard')
+        if policy not in POLICIES:
+            raise CommandError("Unknown policy '%s', use one of %s" % (policy, ', '.join(POLICIES)))
+        if options['archive'] and options['purge_after'] is None:
+            raise CommandError('--archive only makes sense with --purge-after')
+
+        reaped = reap_sessions(timeout, policy, options['batch'])
+        self.stdout.write("Timed out %d sessions\n" % reaped)
+
+        if options['purge_after'] is not None:
+            archive = options['archive'] and open(options['archive'], 'a')
+            try:
+                purged = purge_navigations(options['purge_after'], archive or None, options['chunk'])
+            finally:
+                if archive:
+                    archive.close()
+            self.stdout.write("Purged %d navigations\n" % purged)
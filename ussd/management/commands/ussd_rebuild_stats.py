@@ -0,0 +1,60 @@
+import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from ussd.funnel import Funnel
+from ussd.models import ScreenStat
+
+OUTCOMES = ('views', 'errors', 'advances', 'completions', 'dropoffs')
+
+
+class Command(BaseCommand):
+    help = """Recomputes the ScreenStat counters from Navigation, for the days in
+--from / --to (all of them by default), replacing what is there.  Counts the
+gateway flushes for those days while this runs are lost, so only rebuild past
+days while the gateway is live.  The screen an open session is waiting on
+isn't logged until the session is answered, completes or is reaped, so
+rebuild days whose sessions have all been closed (see ussd_reap)."""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--from', dest='start', help='First day to rebuild (YYYY-MM-DD)'),
+        make_option('--to', dest='end', help='Day after the last one to rebuild (YYYY-MM-DD)'),
+        make_option('--chunk', type='int', default=10000, help='Navigations read per query'),
+        make_option('--database', default=None, help='Database alias to read navigations from'),
+    )
+
+    def handle(self, **options):
+        start, end = [self.parse_date(options[k]) for k in ('start', 'end')]
+        funnel = Funnel(start, end, using=options['database'])
+        funnel.run(options['chunk'])
+
+        stats = []
+        for row in funnel.rows():
+            day = datetime.datetime.strptime(row['day'], '%Y-%m-%d').date()
+            for outcome in OUTCOMES:
+                if row[outcome]:
+                    stats.append(ScreenStat(screen_id=row['screen'], day=day, outcome=outcome, count=row[outcome]))
+
+        with transaction.commit_on_success():
+            existing = ScreenStat.objects.all()
+            if start:
+                existing = existing.filter(day__gte=start.date())
+            if end:
+                existing = existing.filter(day__lt=end.date())
+            existing.delete()
+            if hasattr(ScreenStat.objects, 'bulk_create'):
+                ScreenStat.objects.bulk_create(stats)
+            else:
+                for stat in stats:
+                    stat.save()
+        self.stdout.write("Wrote %d counters\n" % len(stats))
+
+    def parse_date(self, value):
+        if not value:
+            return None
+        try:
+            return datetime.datetime.strptime(value, '%Y-%m-%d')
+        except ValueError:
+            raise CommandError("Invalid date '%s', use YYYY-MM-DD" % value)
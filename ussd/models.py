@@ -1,4 +1,4 @@
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from django.forms import ValidationError
 from mptt.models import MPTTModel
 from rapidsms.models import Connection
@@ -7,10 +7,26 @@ from uganda_common.models import PolymorphicManager, PolymorphicMixin
 from rapidsms_xforms.models import XFormSubmission, XFormSubmissionValue, XFormField
 import django
 from django.conf import settings
+from django.utils import simplejson as json
+from django.utils.encoding import smart_str
+from django.db.models.signals import post_save, post_delete
+from .buffer import log_navigations
+from .counters import count_screen
+from .deadline import DeadlineExceeded, check_deadline, commit_deadline, defer
+from .graph import get_graph, get_table_graph, get_version_graph, invalidate_graph
+from .instrumentation import carried, timed
+from .workers import run_in_background, send_with_retry
+import datetime
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
 
 # fired right before each screen gets a chance to process its input
 ussd_pre_transition = django.dispatch.Signal(providing_args=["screen", "input", "session"])
 ussd_complete = django.dispatch.Signal(providing_args=["session"])
+# fired when a session the gateway abandoned is closed (see ussd.reaper)
+ussd_timeout = django.dispatch.Signal(providing_args=["session", "policy"])
 
 class BackNavigation(Exception):
     """
@@ -57,6 +73,28 @@ class Screen(MPTTModel, PolymorphicMixin):
     def is_terminal(self):
         return True
 
+    def get_graph(self):
+        """
+        The graph this screen came from, so a screen of a pinned tree
+        version keeps rendering and navigating within that version.
+        Screens loaded straight from the database use the current graph.
+        """
+        return getattr(self, '_graph', None) or get_graph()
+
+    def resolve(self, graph=None):
+        """
+        Returns the most specific instance of this screen.  Screens the
+        screen graph knows about come from there, with their relations
+        (next, field, field.xform) already loaded, so downcast() only costs
+        queries for screens created since the graph was compiled.
+        """
+        if type(self) is not Screen:
+            return self
+        graph = graph or self.get_graph()
+        if self.pk in graph:
+            return graph.screen(self.pk)
+        return self.downcast()
+
     slug = models.SlugField(primary_key=True)
 
     # The label to display when navigating to this submenu
@@ -89,7 +127,14 @@ class Menu(Screen, PolymorphicMixin):
     has_errors = False
     error_text = ''
 
+    # menus render purely from the tree, so their text can be memoized
+    # (see ScreenGraph.render)
+    cache_text = True
+
     def __unicode__(self):
+        return self.get_graph().render(self)
+
+    def render(self):
         """
         This renders a standard menu, based on the children of the 
         current menu item.  An example might be:
@@ -104,7 +149,7 @@ class Menu(Screen, PolymorphicMixin):
             toret.append((order, label,))
 
 
-        if self.parent:
+        if self.parent_id:
             toret.append((getattr(settings,"BACK_KEY","#"), 'Back'))
         toret = "\n".join("%s. %s" % (order, label) for order, label in toret)
 
@@ -121,22 +166,22 @@ class Menu(Screen, PolymorphicMixin):
         example return value:
         [('meat',1),('vegetables',2),('fruits', 4)]
         '''
-        for c in self.get_children().order_by('order'):
+        for c in self.get_graph().get_children(self.slug):
             yield c.get_label(), c.order
 
     def is_terminal(self):
-        return self.get_children().count() == 0
+        return self.get_graph().is_leaf(self.slug)
 
     def accept_input(self, input, session=None):
         try:
             order = int(input)
-            return self.get_children().get(order=order)
+            child = self.get_graph().child(self.slug, order)
+            if child is not None:
+                return child
         except ValueError:
             if input == getattr(settings,"BACK_KEY","#"):
                 raise BackNavigation()
             # else fall through to error case
-        except Screen.DoesNotExist:
-            pass
 
         self.has_errors = True
         self.error_label = "Invalid Menu Option."
@@ -154,6 +199,8 @@ class Question(Screen, PolymorphicMixin):
     has_errors = False
     error_text = ''
 
+    cache_text = True
+
     question_text = models.TextField()
 
     # Questions aren't menus, so there's only one default screen
@@ -164,16 +211,22 @@ class Question(Screen, PolymorphicMixin):
         return self.question_text
 
     def is_terminal(self):
-        return self.next is None
+        return self.next_id is None
+
+    def get_next(self):
+        return self.get_graph().next(self.slug)
 
     def accept_input(self, input, session=None):
         """
         Simply advance to the next screen. Subclasses will likely override
         this default behavior.
         """
-        return self.next
+        return self.get_next()
 
     def __unicode__(self):
+        return self.get_graph().render(self)
+
+    def render(self):
         if self.has_errors:
             return "%s\n%s" % (self.error_text, self.get_question())
 
@@ -185,9 +238,13 @@ class Field(Question, PolymorphicMixin):
     Fields are questions whose answers map to an XFormField.  As this is an
     integral part of what our USSD sessions are about, the XFormSubmissions that
     are created from these fields are stored on the USSD session object itself.
+    Answers are validated as they come in, but only written as submissions
+    once the session completes (see Session.save_answers).
     """
     objects = PolymorphicManager()
 
+    cache_text = True
+
     # The field this question is associated with
     field = models.ForeignKey(XFormField)
 
@@ -197,30 +254,16 @@ class Field(Question, PolymorphicMixin):
 
     def accept_input(self, input, session=None):
         try:
-            field = self.field
-            val = field.clean_submission(input, 'ussd')
-
-            # try to get an existing submission
-            try:
-                submission = session.submissions.get(xform=self.field.xform)
-            except XFormSubmission.DoesNotExist:
-                submission = XFormSubmission.objects.create(xform=self.field.xform, has_errors=True, connection=session.connection)
-                session.submissions.add(submission)
-
-            try:
-                # try deleting any previous values for this amount
-                subval = submission.values.get(attribute=self.field, entity_id=submission.pk)
-                subval.delete()
-            except XFormSubmissionValue.DoesNotExist:
-                pass
-
-            submission.values.create(attribute=self.field, value=val, entity=submission)
-            return self.next
+            self.field.clean_submission(input, 'ussd')
         except ValidationError, e:
             self.error_text = "\n".join(e.messages)
             self.has_errors = True
             return self
 
+        # the answer is written out with the rest when the session completes
+        session.buffer_answer(self.field, input)
+        return self.get_next()
+
 
 class StubScreen(Screen, PolymorphicMixin):
 
@@ -242,21 +285,72 @@ class StubScreen(Screen, PolymorphicMixin):
 
 class Session(models.Model):
 
+    STATUS_CHOICES = (
+        ('open', 'Open'),
+        ('complete', 'Complete'),
+        ('timeout', 'Timed out'),
+    )
+
     #a unique session identifier which is maintained for an entire USSD session/transaction
     transaction_id = models.CharField(max_length=100)
 
+    # The code the subscriber dialed ('ussdServiceCode'), transaction ids are
+    # only unique per service code
+    service_code = models.CharField(max_length=20, default='')
+
     #The telephone number of the subscriber interacting with the USSD code
     # match this with 'msisdn'
     connection = models.ForeignKey(Connection)
 
     submissions = models.ManyToManyField(XFormSubmission)
 
+    # The screens this session has navigated through, as a JSON list of
+    # [slug, text, response] entries, most recent last.  The text is left
+    # out (null) when the screen will render to exactly the same text again.
+    stack = models.TextField(default='[]')
+
+    # Validated answers to Field screens, as a JSON object of XFormField pk
+    # to raw input, written out as submissions when the session completes.
+    answers = models.TextField(default='{}')
+
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='open')
+
+    # when the session was last saved, for finding abandoned sessions
+    last_activity = models.DateTimeField(default=datetime.datetime.now, db_index=True)
+
+    # The TreeVersion the session started on, and keeps navigating until it
+    # ends, whatever is activated in the meantime.  Blank when no version
+    # was active: the session follows the Screen tables.
+    tree_version = models.CharField(max_length=40, blank=True, default='')
+
+    # Navigation audit rows that haven't been written to the database yet,
+    # for sessions kept in a write-behind SessionStore (see ussd.store).
+    # None means navigations are written as they happen.
+    pending_navigations = None
+
+    class Meta:
+        unique_together = (('service_code', 'transaction_id'),)
+
+    def get_graph(self):
+        """
+        The graph of the tree version this session started on; sessions
+        started on the Screen tables stay on them, even once a version
+        has been activated.
+        """
+        if self.tree_version:
+            return get_version_graph(self.tree_version)
+        return get_table_graph()
+
     def get_initial_screen(self):
+        graph = self.get_graph()
         try:
-            toret = getattr(settings, 'INITIAL_USSD_SCREEN', Screen.tree.root_nodes()[0])
+            toret = getattr(settings, 'INITIAL_USSD_SCREEN', None) or graph.roots[0]
             if callable(toret):
                 toret = toret()
-            return Screen.objects.get(slug=toret)
+            toret = getattr(toret, 'slug', toret)
+            if toret not in graph:
+                raise Screen.DoesNotExist()
+            return graph.screen(toret)
         except IndexError:
             from django.core.exceptions import ImproperlyConfigured
             raise ImproperlyConfigured('You need to supply an INITIAL_USSD_SCREEN variable in your settings.py')
@@ -264,28 +358,97 @@ class Session(models.Model):
             from django.core.exceptions import ImproperlyConfigured
             raise ImproperlyConfigured("You need to supply a proper INITIAL_USSD_SCREEN variable in your settings.py, not Screen with slug '%s' was found" % toret)
 
+    def get_stack(self):
+        if not hasattr(self, '_stack'):
+            self._stack = json.loads(self.stack or '[]')
+        return self._stack
+
+    def get_answers(self):
+        if not hasattr(self, '_answers'):
+            self._answers = json.loads(self.answers or '{}')
+        return self._answers
+
+    def buffer_answer(self, field, input):
+        # answering the same field again replaces the previous answer
+        self.get_answers()[str(field.pk)] = input
+
+    def save_state(self):
+        self.stack = json.dumps(self.get_stack())
+        self.answers = json.dumps(self.get_answers())
+        self.last_activity = datetime.datetime.now()
+        Session.objects.filter(pk=self.pk).update(stack=self.stack, answers=self.answers,
+                                                  status=self.status, last_activity=self.last_activity)
+
+    def push_navigation(self, screen, text):
+        stack = self.get_stack()
+        stack.append([screen.pk, None if self.get_graph().is_canonical(screen) else text, None])
+        depth = getattr(settings, 'USSD_STACK_DEPTH', 20)
+        if len(stack) > depth:
+            # always keep the initial screen, so the user can get back to it
+            del stack[1:len(stack) - depth + 1]
+
+    def last_navigation(self):
+        stack = self.get_stack()
+        if stack:
+            return stack[-1]
+        return None
+
+    def navigation_text(self, entry):
+        slug, text, response = entry
+        if text is None:
+            screen = self.get_graph().screen(slug)
+            text = str(screen) if screen else StubScreen().text
+        return text
+
+    def save_response(self, input):
+        entry = self.last_navigation()
+        if entry:
+            entry[2] = input
+            self.log_navigation(entry)
+
+    def log_navigation(self, entry, date=None):
+        slug, text, response = entry
+        # canonical screens get no text, it can be rendered again
+        nav = Navigation(session_id=self.pk, screen_id=slug, text=text, response=response or '')
+        if date is not None:
+            nav.date = date
+        if self.pending_navigations is None:
+            log_navigations([nav])
+        else:
+            self.pending_navigations.append(nav)
+
+    def save_navigations(self):
+        '''
+        Writes out the navigations held back by a write-behind store.
+        '''
+        if self.pending_navigations:
+            log_navigations(self.pending_navigations)
+            self.pending_navigations = []
+
     def last_screen(self):
-        try:
-            return self.navigations.latest('date').screen
-        except Navigation.DoesNotExist:
+        entry = self.last_navigation()
+        if entry is None:
             return None
+        return self.get_graph().screen(entry[0])
 
     def back(self):
         '''
         Return to the previous menu in navigation (i.e., the second-to-last screen
         in navigations).
         '''
-        navs = self.navigations.order_by('-date')
-        if navs.count():
-            navs[0].delete()
+        stack = self.get_stack()
+        if stack:
+            stack.pop()
 
         # don't return the screens unicode method, as this may not
         # have the full text we're looking for (screens can supply
         # state-driven text that we will have lost at this point).
-        try:
-            return self.navigations.all().latest('date').text
-        except Navigation.DoesNotExist:
+        entry = self.last_navigation()
+        if entry is None:
             return StubScreen().text
+        # the screen is waiting for a response again
+        entry[2] = None
+        return self.navigation_text(entry)
 
 
     def advance_progress(self, input):
@@ -293,59 +456,290 @@ class Session(models.Model):
         Navigate down the tree, based on the number the user has input.
         '''
         if input.rsplit("_")[0] == getattr(settings,"BACK_KEY","#"):
-            return StubScreen(text=self.back(), terminal=False)
+            self.save_response(input)
+            return self.go_back()
         screen = self.last_screen()
         if not screen:
             screen = self.get_initial_screen()
-            self.navigations.create(session=self, screen=screen, text=str(screen.downcast()))
-            return screen.downcast()
+            commit_deadline()
+            self.push_navigation(screen, str(screen))
+            count_screen(screen.pk, 'views')
+            return screen
 
-        nav = self.navigations.latest('date')
-        nav.response = input
-        nav.save()
+        screen = screen.resolve(self.get_graph())
+        # the session isn't changed until the hop commits to its next
+        # screen, so a hop abandoned before then leaves it as it was
+        answers = dict(self.get_answers())
 
         #check for back navigation
 
         try:
-            ussd_pre_transition.send(sender=self, screen=screen, input=input.rsplit("_")[0], session=self)
+            check_deadline()
+            with timed('pre_transition'):
+                ussd_pre_transition.send(sender=self, screen=screen, input=input.rsplit("_")[0], session=self)
+            check_deadline()
             #handle equatel
-            next = screen.downcast().accept_input(input.rsplit("_")[0], self)
+            next = screen.accept_input(input.rsplit("_")[0], self)
             if not next:
                 # this is actually an improperly configured USSD menu, but
                 # we're relaxing constraints and not blowing up in the
                 # case of a leaf node without any successor screen
                 next = StubScreen()
-            self.navigations.create(session=self, screen=next, text=str(next.downcast()))
-            if next.downcast().is_terminal():
-                self.complete()
-            return next.downcast()
+            return self.navigate_to(next, input)
         except BackNavigation:
-            return StubScreen(text=self.back(), terminal=False)
+            self.save_response(input)
+            return self.go_back()
         except TransitionException as e:
-            next = e.screen
-            self.navigations.create(session=self, screen=next, text=str(next.downcast()))
-            if next.downcast().is_terminal():
-                self.complete()
-            return next.downcast()
+            return self.navigate_to(e.screen, input)
+        except DeadlineExceeded:
+            # Field screens buffer their answer as they accept it
+            self._answers = answers
+            raise
+
+    def go_back(self):
+        entry = self.last_navigation()
+        text = self.back()
+        if entry:
+            count_screen(entry[0], 'advances')
+        # the screen gone back to is shown again
+        previous = self.last_navigation()
+        if previous:
+            count_screen(previous[0], 'views')
+        return StubScreen(text=text, terminal=False)
+
+    def navigate_to(self, screen, input=None):
+        '''
+        Records ``input`` as the response to the current screen, and pushes
+        the next screen onto the navigation stack, completing the session if
+        it is terminal.  The screen is resolved to its most specific type
+        once, and that instance is used from here on.
+        '''
+        screen = screen.resolve(self.get_graph())
+        # past this point the hop runs to completion, whatever its deadline
+        commit_deadline()
+        if input is not None:
+            self.save_response(input)
+        previous = self.last_navigation()
+        self.push_navigation(screen, str(screen))
+        if previous:
+            count_screen(previous[0], 'errors' if previous[0] == screen.pk else 'advances')
+        count_screen(screen.pk, 'views')
+        if screen.is_terminal():
+            self.complete()
+        return screen
 
     def complete(self):
+        self.status = 'complete'
+        count_screen(self.last_navigation()[0], 'completions')
+        # the terminal screen never gets a response, log it as it stands
+        self.log_navigation(self.last_navigation())
+        self.save_navigations()
+        defer(self.finalize)
+
+    def finalize(self):
+        '''
+        Writes out the session's answers, marks its submissions as complete
+        and fires ussd_complete, in the background if USSD_COMPLETE_ASYNC is set.
+        '''
+        if getattr(settings, 'USSD_COMPLETE_ASYNC', False):
+            run_in_background(carried(self.send_complete), robust=True)
+        else:
+            self.send_complete()
+
+    def save_answers(self):
+        '''
+        Writes the buffered answers out as one XFormSubmission per XForm,
+        in a single transaction.  Doing this again replaces the values
+        written the first time.
+        '''
+        answers = self.get_answers()
+        if not answers:
+            return
+        fields = XFormField.objects.filter(pk__in=answers.keys()).select_related('xform')
+        with transaction.commit_on_success():
+            submissions = dict((s.xform_id, s) for s in self.submissions.all())
+            for field in fields:
+                try:
+                    val = field.clean_submission(answers[str(field.pk)], 'ussd')
+                except ValidationError:
+                    # the field has changed since the answer was accepted
+                    logger.warning('Dropped answer to %s for session %s' % (field.command, self.pk))
+                    continue
+                submission = submissions.get(field.xform_id)
+                if submission is None:
+                    submission = XFormSubmission.objects.create(xform=field.xform, has_errors=True, connection_id=self.connection_id)
+                    self.submissions.add(submission)
+                    submissions[field.xform_id] = submission
+                else:
+                    submission.values.filter(attribute=field).delete()
+                # values are multi-table children of eav's Value, so they
+                # can't be bulk created
+                submission.values.create(attribute=field, value=val, entity=submission)
+
+    def send_complete(self, robust=False):
+        with timed('save_answers'):
+            self.save_answers()
         self.submissions.update(has_errors=False)
-        ussd_complete.send(sender=self, session=self)
+        with timed('complete'):
+            if robust:
+                send_with_retry(ussd_complete, sender=self, session=self)
+            else:
+                ussd_complete.send(sender=self, session=self)
 
+    def time_out(self, policy='discard'):
+        '''
+        Closes a session the gateway abandoned.  The answers given so far
+        are dropped along with any incomplete submissions ('discard'),
+        written as incomplete submissions ('keep'), or written and marked
+        complete ('finalize').  Call send_timeout() once this is committed.
+        '''
+        if policy == 'discard':
+            self.submissions.filter(has_errors=True).delete()
+        else:
+            self.save_answers()
+            if policy == 'finalize':
+                self.submissions.update(has_errors=False)
+        self.status = 'timeout'
+        Session.objects.filter(pk=self.pk).update(status=self.status)
+
+    def send_timeout(self, policy='discard'):
+        '''
+        Logs the screen the session was left on, counts the drop-off and
+        fires ussd_timeout, for a session closed by time_out().
+        '''
+        entry = self.last_navigation()
+        if entry:
+            # it never got a response, log it as it stands, as of when it was shown
+            self.log_navigation(entry, self.last_activity)
+            self.save_navigations()
+            count_screen(entry[0], 'dropoffs', self.last_activity.date())
+        send_with_retry(ussd_timeout, sender=self, reconnect=False, session=self, policy=policy)
 
-class Navigation(models.Model):
+
+class ScreenStat(models.Model):
     """
-    A Navigation is a record of a single screen that the user viewed, and together
-    these comprise a stack of navigations the user has made within a session.  Because
-    the text rendered to screen may be state-driven (i.e., based on erroneous input, etc.)
-    The actual text sent is stored, along with the Screen that generated it.  In this way,
-    when a user navigates backwards, they'll receive the previous text sent, not the stateless
-    screen text from an initial navigation.
+    How many times ``outcome`` happened on a screen in a day, kept up to
+    date by ussd.counters.
     """
     screen = models.ForeignKey(Screen)
+    day = models.DateField()
+    outcome = models.CharField(max_length=20)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = (('screen', 'day', 'outcome'),)
+
+
+class TreeVersion(models.Model):
+    """
+    A snapshot of the whole screen tree, as a compiled graph artifact (see
+    ussd.graph.dump_graph), keyed by the artifact's version hash.  Versions
+    are never changed once published; see ussd.graph.activate_version.
+    """
+    version = models.CharField(max_length=40, primary_key=True)
+    artifact = models.TextField()
+    created = models.DateTimeField(default=datetime.datetime.now)
+
+    def __unicode__(self):
+        return self.version
+
+
+class ActiveTree(models.Model):
+    """
+    The single row (pk 1) pointing at the TreeVersion new sessions start on.
+    """
+    version = models.ForeignKey(TreeVersion)
+
+
+class NavigationText(models.Model):
+    """
+    A distinct piece of text sent to a subscriber, stored once however many
+    navigations showed it, and keyed by its SHA-1.
+    """
+    hash = models.CharField(max_length=40, primary_key=True)
     text = models.TextField()
+
+    @staticmethod
+    def hash_text(text):
+        return hashlib.sha1(smart_str(text)).hexdigest()
+
+
+# hashes known to have a NavigationText row, so they aren't looked up again
+_known_texts = set()
+
+
+def save_texts(navigations):
+    """
+    Makes sure the NavigationText rows the navigations refer to exist.
+    """
+    texts = dict((nav.content_id, nav._text) for nav in navigations
+                 if getattr(nav, '_text', None) is not None and nav.content_id not in _known_texts)
+    if not texts:
+        return
+    existing = NavigationText.objects.filter(hash__in=texts.keys()).values_list('hash', flat=True)
+    for hash in set(texts) - set(existing):
+        # another process may be writing the same text
+        sid = transaction.savepoint()
+        try:
+            NavigationText.objects.create(hash=hash, text=texts[hash])
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+    if len(_known_texts) > getattr(settings, 'USSD_TEXT_CACHE_SIZE', 10000):
+        _known_texts.clear()
+    _known_texts.update(texts)
+
+
+def forget_texts(navigations):
+    """
+    Makes save_texts() check the navigations' texts again, e.g. after the
+    transaction that wrote them was rolled back.
+    """
+    _known_texts.difference_update(nav.content_id for nav in navigations)
+
+
+class Navigation(models.Model):
+    """
+    A Navigation is a record of a single screen that the user viewed, and the response
+    they gave to it.  Navigations are an append-only log, written as each response comes
+    in (or when the session completes, for the final screen); the live navigation stack
+    used for backwards navigation is kept on Session.stack.  Because the text rendered
+    to screen may be state-driven (i.e., based on erroneous input, etc.) the actual text
+    sent is stored, along with the Screen that generated it, but only when it differs
+    from the screen's canonical text (see ScreenGraph.is_canonical).  Texts are stored
+    once each, as NavigationText.
+    """
+    screen = models.ForeignKey(Screen)
+    # null when the screen showed its canonical text
+    content = models.ForeignKey(NavigationText, null=True, blank=True)
     response = models.TextField()
-    date = models.DateTimeField(auto_now_add=True)
+    # set when the navigation is logged, not when it is written (see ussd.buffer)
+    date = models.DateTimeField(default=datetime.datetime.now)
     session = models.ForeignKey(Session, related_name='navigations')
 
+    def _get_text(self):
+        if getattr(self, '_text', None) is not None:
+            return self._text
+        if self.content_id is not None:
+            return self.content.text
+        graph = self.session.get_graph()
+        screen = graph.screen(self.screen_id) or self.screen.resolve(graph)
+        return str(screen)
+
+    def _set_text(self, text):
+        self._text = text
+        self.content_id = None if text is None else NavigationText.hash_text(text)
+
+    text = property(_get_text, _set_text)
+
+    def save(self, *args, **kwargs):
+        save_texts([self])
+        super(Navigation, self).save(*args, **kwargs)
+
+
+def screen_changed(sender, **kwargs):
+    if issubclass(sender, (Screen, XFormField)):
+        invalidate_graph()
 
+post_save.connect(screen_changed, dispatch_uid='ussd.graph.post_save')
+post_delete.connect(screen_changed, dispatch_uid='ussd.graph.post_delete')
@@ -0,0 +1,76 @@
+"""
+Closing sessions the gateway abandoned, and purging old navigations.
+
+Sessions that never reach a terminal screen stay 'open' forever.  The
+ussd_reap command (run it from cron) times out open sessions whose
+last_activity is older than USSD_REAP_TIMEOUT seconds (an hour by
+default), applying USSD_TIMEOUT_POLICY to their answers (see
+Session.time_out), and can delete the navigations of closed sessions
+after some days, optionally archiving them first.  Both work in small
+batches, each in its own transaction, so no lock is held for long.
+
+Keep the timeout well above USSD_SESSION_TIMEOUT: sessions in a
+write-behind store only touch last_activity when they are persisted.
+"""
+import datetime
+import logging
+
+from django.db import transaction
+from django.utils import simplejson as json
+
+from .models import Session, Navigation
+
+logger = logging.getLogger(__name__)
+
+
+def reap_sessions(timeout, policy='discard', batch_size=500):
+    """
+    Times out every open session idle for more than ``timeout`` seconds,
+    oldest first.  Returns the number of sessions closed.
+    """
+    cutoff = datetime.datetime.now() - datetime.timedelta(seconds=timeout)
+    reaped = 0
+    failed = []
+    while True:
+        # sessions timed out drop out of the query, those that failed are skipped
+        sessions = list(Session.objects.filter(status='open', last_activity__lt=cutoff).exclude(pk__in=failed).order_by('last_activity')[:batch_size])
+        if not sessions:
+            return reaped
+        for session in sessions:
+            try:
+                with transaction.commit_on_success():
+                    session.time_out(policy)
+            except Exception:
+                # leave it open, to be tried again next run
+                logger.exception('Could not time out session %s' % session.pk)
+                failed.append(session.pk)
+                continue
+            # receivers (and their retries) run once the session is closed
+            session.send_timeout(policy)
+            reaped += 1
+
+
+def purge_navigations(days, archive=None, chunk_size=1000):
+    """
+    Deletes the navigations of closed sessions idle for more than ``days``
+    days, ``chunk_size`` rows at a time.  Each chunk is first written to
+    the file-like ``archive``, if given, one JSON object per line.
+    Returns the number of navigations deleted.
+    """
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=days)
+    navigations = Navigation.objects.filter(session__last_activity__lt=cutoff).exclude(session__status='open')
+    purged = 0
+    while True:
+        chunk = list(navigations.order_by('pk').values('id', 'session', 'screen', 'content__text', 'response', 'date')[:chunk_size])
+        if not chunk:
+            return purged
+        if archive is not None:
+            for row in chunk:
+                # text is null for screens that showed their canonical text
+                row['text'] = row.pop('content__text')
+                row['date'] = row['date'].isoformat()
+                archive.write(json.dumps(row) + "\n")
+            archive.flush()
+        with transaction.commit_on_success():
+            Navigation.objects.filter(pk__in=[row['id'] for row in chunk]).delete()
+        purged += len(chunk)
@@ -0,0 +1,116 @@
+"""
+Routing msisdns to rapidsms backends by number prefix.
+
+uganda_common's assign_backend looks a number's backend up in the
+BACKEND_PREFIXES setting, a list of (backend name, [prefixes]) pairs with
+prefixes given after the country code (COUNTRY_CALLING_CODE, '256' by
+default), e.g.::
+
+    BACKEND_PREFIXES = [
+        ('mtn', ['77', '78']),
+        ('warid', ['70']),
+    ]
+
+Here the same table is compiled once into a digit trie, with the backends
+loaded up front, so routing a number is a walk down the trie with no
+database access.  Numbers are normalized exactly as assign_backend does,
+so connections get the same identity either way.  Numbers that match no
+prefix, or prefixes of more than one backend, are left to assign_backend.
+"""
+import threading
+
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+from rapidsms.models import Backend
+from uganda_common.utils import assign_backend
+
+
+class PrefixRouter(object):
+
+    def __init__(self, prefixes, country_code='256'):
+        self.country_code = country_code
+        self.root = {}
+        names = set(name for name, backend_prefixes in prefixes)
+        backends = dict((b.name, b) for b in Backend.objects.filter(name__in=names))
+        for name, backend_prefixes in prefixes:
+            if name not in backends:
+                backends[name], created = Backend.objects.get_or_create(name=name)
+            for prefix in backend_prefixes:
+                node = self.root
+                for digit in country_code + prefix:
+                    node = node.setdefault(digit, {})
+                # None can't clash with a digit
+                node.setdefault(None, set()).add(backends[name])
+        self.hits = 0
+        self.misses = 0
+
+    def normalize(self, msisdn):
+        """
+        The identity assign_backend gives ``msisdn``.
+        """
+        if msisdn.startswith('0'):
+            return '%s%s' % (self.country_code, msisdn[1:])
+        if msisdn[:len(self.country_code)] != self.country_code:
+            return '%s%s' % (self.country_code, msisdn)
+        return msisdn
+
+    def match(self, identity):
+        """
+        Returns the backend whose prefixes ``identity`` starts with, or
+        None if there isn't exactly one.
+        """
+        node = self.root
+        backends = set()
+        for digit in identity:
+            node = node.get(digit)
+            if node is None:
+                break
+            backends.update(node.get(None, ()))
+        if len(backends) == 1:
+            return backends.pop()
+        return None
+
+    def route(self, msisdn):
+        identity = self.normalize(msisdn)
+        backend = self.match(identity)
+        if backend is None:
+            self.misses += 1
+            return assign_backend(msisdn)
+        self.hits += 1
+        return identity, backend
+
+    def stats(self):
+        return {'hits':self.hits, 'misses':self.misses}
+
+
+_router = None
+_lock = threading.Lock()
+
+
+def get_router():
+    global _router
+    if _router is None:
+        _lock.acquire()
+        try:
+            if _router is None:
+                _router = PrefixRouter(getattr(settings, 'BACKEND_PREFIXES', []),
+                                       getattr(settings, 'COUNTRY_CALLING_CODE', '256'))
+        finally:
+            _lock.release()
+    return _router
+
+
+def route(msisdn):
+    """
+    Returns the (identity, backend) pair for ``msisdn``, in the same
+    form as assign_backend.
+    """
+    return get_router().route(msisdn)
+
+
+def backend_changed(sender, **kwargs):
+    global _router
+    _router = None
+
+post_save.connect(backend_changed, sender=Backend, dispatch_uid='ussd.routing.post_save')
+post_delete.connect(backend_changed, sender=Backend, dispatch_uid='ussd.routing.post_delete')
@@ -0,0 +1,255 @@
+"""
+Where live USSD sessions are kept between gateway hops.
+
+The store is chosen with the USSD_SESSION_STORE setting (a dotted path to a
+SessionStore subclass), and defaults to DatabaseSessionStore, which reads
+and writes Session and Navigation rows on every hop.
+
+The cache and in-memory stores keep the live Session, its navigation stack
+and its Navigation log out of the database until it completes or times
+out (USSD_SESSION_TIMEOUT seconds, 180 by default).  Note that the
+in-memory store is per-process: only use it when a single process serves
+all hops of a transaction.
+"""
+import datetime
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, transaction
+from django.utils.importlib import import_module
+from rapidsms.models import Connection
+
+from .connections import refresh_connection
+from .graph import session_version
+from .models import Session
+
+
+class SessionStore(object):
+    """
+    Base class for session stores.  Subclasses that hold sessions outside
+    of the database set ``write_behind`` and implement load() and save().
+    """
+    write_behind = False
+
+    def get(self, transaction_id, service_code=''):
+        """
+        Returns the live Session for this transaction, or None.
+        """
+        session = self.load(transaction_id, service_code)
+        if session is None:
+            try:
+                session = Session.objects.get(service_code=service_code, transaction_id=transaction_id)
+            except Session.DoesNotExist:
+                return None
+        return session
+
+    def create(self, transaction_id, connection, service_code=''):
+        """
+        Starts a new session.  If the gateway has retried the request and the
+        session was started concurrently, that session is returned instead.
+        If ``connection`` came from the connection cache but has since been
+        deleted, the session is started on a fresh one.
+        """
+        try:
+            return self._create(transaction_id, connection, service_code)
+        except IntegrityError:
+            if Connection.objects.filter(pk=connection.pk).exists():
+                raise
+            return self._create(transaction_id, refresh_connection(connection), service_code)
+
+    def _create(self, transaction_id, connection, service_code):
+        # the savepoint needs a managed transaction to live in
+        with transaction.commit_on_success():
+            sid = transaction.savepoint()
+            try:
+                session = Session.objects.create(service_code=service_code, transaction_id=transaction_id, connection=connection,
+                                                 tree_version=session_version() or '')
+                transaction.savepoint_commit(sid)
+            except IntegrityError, e:
+                transaction.savepoint_rollback(sid)
+                session = self.get(transaction_id, service_code)
+                if session is None:
+                    # not a retry, the connection is gone
+                    raise e
+                return session
+
+        if self.write_behind:
+            session.pending_navigations = []
+        return session
+
+    def load(self, transaction_id, service_code):
+        return None
+
+    def save(self, session):
+        """
+        Called after every hop that leaves the session open.
+        """
+        session.save_state()
+
+    def finish(self, session):
+        """
+        Called once the session has reached a terminal screen.
+        """
+        self.persist(session)
+
+    def persist(self, session):
+        """
+        Writes the session's navigation stack and buffered answers, and
+        any navigations still held back, to the database.
+        """
+        session.save_state()
+        session.save_navigations()
+
+    def get_timeout(self):
+        return getattr(settings, 'USSD_SESSION_TIMEOUT', 180)
+
+
+class DatabaseSessionStore(SessionStore):
+    pass
+
+
+class CacheSessionStore(SessionStore):
+    """
+    Keeps live sessions in Django's cache.  Each process remembers the
+    sessions it saved, and writes out the ones that have timed out, with
+    their navigations, like MemorySessionStore does.  Cache entries live
+    for three times the timeout, so they are still there to be written.
+    """
+    write_behind = True
+
+    def __init__(self):
+        # cache key -> last_activity of the session as this process saved it
+        self.saved = {}
+        self.lock = threading.Lock()
+        self.last_expiry = time.time()
+
+    def key(self, transaction_id, service_code):
+        return 'ussd-session-%s-%s' % (service_code, transaction_id)
+
+    def load(self, transaction_id, service_code):
+        self.expire()
+        return cache.get(self.key(transaction_id, service_code))
+
+    def save(self, session):
+        key = self.key(session.transaction_id, session.service_code)
+        session.last_activity = datetime.datetime.now()
+        cache.set(key, session, self.get_timeout() * 3)
+        self.lock.acquire()
+        try:
+            self.saved[key] = session.last_activity
+        finally:
+            self.lock.release()
+
+    def finish(self, session):
+        SessionStore.finish(self, session)
+        key = self.key(session.transaction_id, session.service_code)
+        cache.delete(key)
+        self.lock.acquire()
+        try:
+            self.saved.pop(key, None)
+        finally:
+            self.lock.release()
+
+    def expire(self, force=False):
+        """
+        Writes out and drops the sessions this process saved that have
+        timed out since.  This runs at most once per timeout period,
+        unless forced.
+        """
+        now = time.time()
+        timeout = self.get_timeout()
+        if not force and now - self.last_expiry < timeout:
+            return
+        self.last_expiry = now
+
+        cutoff = datetime.datetime.now() - datetime.timedelta(seconds=timeout)
+        self.lock.acquire()
+        try:
+            expired = [(key, saved) for key, saved in self.saved.items() if saved < cutoff]
+            for key, saved in expired:
+                del self.saved[key]
+        finally:
+            self.lock.release()
+
+        for key, saved in expired:
+            session = cache.get(key)
+            # finished, or saved since by another process, which writes it out
+            if session is None or session.last_activity != saved:
+                continue
+            cache.delete(key)
+            self.persist(session)
+
+
+class MemorySessionStore(SessionStore):
+    """
+    Keeps live sessions in a dict in this process.  Sessions idle for longer
+    than the timeout are written to the database and dropped.
+    """
+    write_behind = True
+
+    def __init__(self):
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.last_expiry = time.time()
+
+    def load(self, transaction_id, service_code):
+        self.expire()
+        try:
+            return self.sessions[(service_code, transaction_id)][1]
+        except KeyError:
+            return None
+
+    def save(self, session):
+        self.lock.acquire()
+        try:
+            self.sessions[(session.service_code, session.transaction_id)] = (time.time(), session)
+        finally:
+            self.lock.release()
+
+    def finish(self, session):
+        SessionStore.finish(self, session)
+        self.lock.acquire()
+        try:
+            self.sessions.pop((session.service_code, session.transaction_id), None)
+        finally:
+            self.lock.release()
+
+    def expire(self, force=False):
+        """
+        Writes out and forgets sessions that have timed out.  This runs at
+        most once per timeout period, unless forced.
+        """
+        now = time.time()
+        timeout = self.get_timeout()
+        if not force and now - self.last_expiry < timeout:
+            return
+        self.last_expiry = now
+
+        self.lock.acquire()
+        try:
+            expired = [session for touched, session in self.sessions.values() if now - touched > timeout]
+            for session in expired:
+                del self.sessions[(session.service_code, session.transaction_id)]
+        finally:
+            self.lock.release()
+
+        for session in expired:
+            self.persist(session)
+
+
+_store = None
+
+
+def get_session_store():
+    global _store
+    if _store is None:
+        path = getattr(settings, 'USSD_SESSION_STORE', 'ussd.store.DatabaseSessionStore')
+        module, attr = path.rsplit('.', 1)
+        try:
+            _store = getattr(import_module(module), attr)()
+        except (ImportError, AttributeError), e:
+            raise ImproperlyConfigured('Error loading USSD_SESSION_STORE %s: %s' % (path, e))
+    return _store
@@ -18,55 +18,71 @@ register = Library()
 
 MPTT_ADMIN_LEVEL_INDENT = getattr(settings, 'MPTT_ADMIN_LEVEL_INDENT', 10)
 
-###
-# Ripped from contrib.admin's items_for_result tag.
-# The only difference is we're indenting nodes according to their level.
-def mptt_items_for_result(cl, result, form):
-    first = True
-    pk = cl.lookup_opts.pk.attname
-    
-    # figure out which field to indent
-    mptt_indent_field = None
+
+def mptt_columns(cl):
+    """
+    Works out, once per changelist, how to display each column of
+    ``list_display``: a tuple of (field_name, model field or None, value
+    getter or None, allow_tags, boolean) per column, plus the name of the
+    column to indent according to each row's level.
+    """
+    columns = []
+    first_callable = None
+    first_field = None
     for field_name in cl.list_display:
         try:
             f = cl.lookup_opts.get_field(field_name)
         except models.FieldDoesNotExist:
-            if mptt_indent_field is None:
-                attr = getattr(result, field_name, None)
-                if callable(attr):
+            f = None
+            # For non-field list_display values, the value is either a method,
+            # property or returned via a callable.
+            if callable(field_name):
+                attr = field_name
+                getter = attr
+            elif hasattr(cl.model_admin, field_name) and \
+               not field_name == '__str__' and not field_name == '__unicode__':
+                attr = getattr(cl.model_admin, field_name)
+                getter = attr
+            else:
+                attr = getattr(cl.model, field_name, None)
+                getter = None
+                if first_callable is None and callable(attr):
                     # first callable field, use this if we can't find any model fields
-                    mptt_indent_field = field_name
+                    first_callable = field_name
+            allow_tags = getattr(attr, 'allow_tags', False)
+            boolean = getattr(attr, 'boolean', False)
+            columns.append((field_name, None, getter, allow_tags or boolean, boolean))
         else:
-            # first model field, use this one
-            mptt_indent_field = field_name
-            break
-    
-    for field_name in cl.list_display:
+            if first_field is None:
+                # first model field, use this one
+                first_field = field_name
+            columns.append((field_name, f, None, False, False))
+    return columns, first_field or first_callable
+
+
+###
+# Ripped from contrib.admin's items_for_result tag.
+# The differences are that we're indenting nodes according to their level,
+# and that the columns are worked out once (see mptt_columns) rather than
+# for every row.
+def mptt_items_for_result(cl, result, form, columns=None):
+    if columns is None:
+        columns = mptt_columns(cl)
+    columns, mptt_indent_field = columns
+    first = True
+    pk = cl.lookup_opts.pk.attname
+
+    for field_name, f, getter, allow_tags, boolean in columns:
         row_class = ''
-        f = None
-        try:
-            f = cl.lookup_opts.get_field(field_name)
-        except models.FieldDoesNotExist:
-            # For non-field list_display values, the value is either a method,
-            # property or returned via a callable.
+        if f is None:
             try:
-                if callable(field_name):
-                    attr = field_name
-                    value = attr(result)
-                elif hasattr(cl.model_admin, field_name) and \
-                   not field_name == '__str__' and not field_name == '__unicode__':
-                    attr = getattr(cl.model_admin, field_name)
-                    value = attr(result)
+                if getter is not None:
+                    value = getter(result)
                 else:
-                    attr = getattr(result, field_name)
-                    if callable(attr):
-                        value = attr()
-                    else:
-                        value = attr
-                allow_tags = getattr(attr, 'allow_tags', False)
-                boolean = getattr(attr, 'boolean', False)
+                    value = getattr(result, field_name)
+                    if callable(value):
+                        value = value()
                 if boolean:
-                    allow_tags = True
                     result_repr = _boolean_icon(value)
                 else:
                     result_repr = smart_unicode(value)
@@ -117,13 +133,17 @@ def mptt_items_for_result(cl, result, form):
                 result_repr = escape(field_val)
         if force_unicode(result_repr) == '':
             result_repr = mark_safe('&nbsp;')
-        
+
+        toggle = ''
         if field_name == mptt_indent_field:
             level = getattr(result, result._mptt_meta.level_attr)
             padding_attr = ' style="padding-left:%spx"' % (5 + MPTT_ADMIN_LEVEL_INDENT * level)
+            if getattr(cl, 'expandable', False) and not result.is_leaf_node():
+                # expanded by the changelist's javascript
+                toggle = u'<a href="#" class="mptt-toggle">+</a> '
         else:
             padding_attr = ''
-        
+
         # If list_display_links not defined, add the link tag to the first field
         if (first and not cl.list_display_links) or field_name in cl.list_display_links:
             table_tag = {True:'th', False:'td'}[first]
@@ -137,8 +157,8 @@ def mptt_items_for_result(cl, result, form):
                 attr = pk
             value = result.serializable_value(attr)
             result_id = repr(force_unicode(value))[1:]
-            yield mark_safe(u'<%s%s%s><a href="%s"%s>%s</a></%s>' % \
-                (table_tag, row_class, padding_attr, url, (cl.is_popup and ' onclick="opener.dismissRelatedLookupPopup(window, %s); return false;"' % result_id or ''), conditional_escape(result_repr), table_tag))
+            yield mark_safe(u'<%s%s%s>%s<a href="%s"%s>%s</a></%s>' % \
+                (table_tag, row_class, padding_attr, toggle, url, (cl.is_popup and ' onclick="opener.dismissRelatedLookupPopup(window, %s); return false;"' % result_id or ''), conditional_escape(result_repr), table_tag))
         else:
             # By default the fields come from ModelAdmin.list_editable, but if we pull
             # the fields out of the form instead of list_editable custom admins
@@ -148,18 +168,19 @@ def mptt_items_for_result(cl, result, form):
                 result_repr = mark_safe(force_unicode(bf.errors) + force_unicode(bf))
             else:
                 result_repr = conditional_escape(result_repr)
-            yield mark_safe(u'<td%s%s>%s</td>' % (row_class, padding_attr, result_repr))
+            yield mark_safe(u'<td%s%s>%s%s</td>' % (row_class, padding_attr, toggle, result_repr))
     if form:
         yield mark_safe(u'<td>%s</td>' % force_unicode(form[cl.model._meta.pk.name]))
 
 
 def mptt_results(cl):
+    columns = mptt_columns(cl)
     if cl.formset:
-        for res, form in zip(cl.result_list, cl.formset.forms):
-            yield list(mptt_items_for_result(cl, res, form))
+        rows = zip(cl.result_list, cl.formset.forms)
     else:
-        for res in cl.result_list:
-            yield list(mptt_items_for_result(cl, res, None))
+        rows = [(res, None) for res in cl.result_list]
+    for res, form in rows:
+        yield {'pk':res.pk, 'items':list(mptt_items_for_result(cl, res, form, columns))}
 
 
 def mptt_result_list(cl):
@@ -169,6 +190,16 @@ def mptt_result_list(cl):
     return {'cl': cl,
             'result_headers': list(result_headers(cl)),
             'results': list(mptt_results(cl))}
-            
+
 # custom template is merely so we can strip out sortable-ness from the column headers
 mptt_result_list = register.inclusion_tag("admin/mptt_change_list_results.html")(mptt_result_list)
+
+
+def mptt_result_rows(cl):
+    """
+    Displays just the rows, for subtrees fetched by the changelist's javascript
+    """
+    return {'cl': cl,
+            'results': list(mptt_results(cl))}
+
+mptt_result_rows = register.inclusion_tag("admin/mptt_change_list_rows.html")(mptt_result_rows)
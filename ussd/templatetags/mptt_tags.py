@@ -243,18 +243,36 @@ class RecurseTreeNode(template.Node):
         self.template_nodes = template_nodes
         self.queryset_var = queryset_var
         
+    def _get_children(self, node):
+        # cache_tree_children has normally fetched them already
+        children = getattr(node, '_cached_children', None)
+        if children is None:
+            children = node.get_children()
+        return children
+
     def _render_node(self, context, node):
-        bits = []
-        context.push()
-        for child in node.get_children():
-            context['node'] = child
-            bits.append(self._render_node(context, child))
-        context['node'] = node
-        context['children'] = mark_safe(u''.join(bits))
-        rendered = self.template_nodes.render(context)
-        context.pop()
-        return rendered
-    
+        """
+        Renders a node after all of its descendants, walking the tree with
+        a stack of (node, remaining children, rendered children) rather
+        than recursing, so deep trees can't hit the recursion limit.
+        """
+        stack = [(node, iter(self._get_children(node)), [])]
+        while True:
+            parent, children, bits = stack[-1]
+            for child in children:
+                stack.append((child, iter(self._get_children(child)), []))
+                break
+            else:
+                stack.pop()
+                context.push()
+                context['node'] = parent
+                context['children'] = mark_safe(u''.join(bits))
+                rendered = self.template_nodes.render(context)
+                context.pop()
+                if not stack:
+                    return rendered
+                stack[-1][2].append(rendered)
+
     def render(self, context):
         queryset = self.queryset_var.resolve(context)
         roots = cache_tree_children(queryset)
@@ -1 +1,4 @@
-
+from ussd.tests.templatetags_tests import *
+from ussd.tests.session_tests import *
+from ussd.tests.graph_tests import *
+from ussd.tests.trees_tests import *
@@ -0,0 +1,36 @@
+from django.test import TestCase
+
+from ussd.benchmark import overridden
+from ussd.graph import invalidate_graph
+from ussd.models import Menu
+
+
+class UssdTestCase(TestCase):
+    """
+    Writes navigations and screen counts as they happen, rather than from
+    the background flushers, and throws away the process-wide screen graph
+    after each test, so screens from its rolled-back transaction never
+    reach the next one.
+    """
+
+    settings_overrides = {'USSD_NAVIGATION_SYNC':True, 'USSD_STATS_SYNC':True}
+
+    def setUp(self):
+        self.overridden = overridden(**self.settings_overrides)
+        self.overridden.__enter__()
+        invalidate_graph()
+
+    def tearDown(self):
+        self.overridden.__exit__(None, None, None)
+        invalidate_graph()
+
+    def create_tree(self):
+        """
+        ussd_root, with child1 (Apples) below it, and child11 and child12
+        below that.  Returns the root.
+        """
+        root = Menu.objects.create(slug='ussd_root', label='Ignored', order=1)
+        child1 = Menu.objects.create(slug='child1', label='Apples', order=1, parent=root)
+        Menu.objects.create(slug='child11', label='Golden Delicious', order=1, parent=child1)
+        Menu.objects.create(slug='child12', label='Granny Smith', order=2, parent=child1)
+        return root
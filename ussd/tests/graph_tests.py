@@ -0,0 +1,98 @@
+from rapidsms.models import Connection, Backend
+
+from ussd.graph import invalidate_graph, activate_version, publish_version, get_active_version, get_graph
+from ussd.models import Menu
+from ussd.store import DatabaseSessionStore
+from ussd.tests.base import UssdTestCase
+
+
+class GraphTest(UssdTestCase):
+
+    def setUp(self):
+        UssdTestCase.setUp(self)
+        root = Menu.objects.create(slug='ussd_root', label='Ignored', order=1)
+        # created out of menu order, so the tree order differs from it
+        Menu.objects.create(slug='pears', label='Pears', order=3, parent=root)
+        Menu.objects.create(slug='apples', label='Apples', order=1, parent=root)
+        Menu.objects.create(slug='plums', label='Plums', order=2, parent=root)
+        invalidate_graph()
+
+    def testChildrenOrder(self):
+        graph = get_graph()
+        self.assertEquals([c.slug for c in graph.get_children('ussd_root')], ['apples', 'plums', 'pears'])
+        self.assertEquals(graph.child('ussd_root', 3).slug, 'pears')
+        self.assertEquals(graph.child('ussd_root', 4), None)
+        self.assertEquals(graph.child('pears', 1), None)
+        self.assertEquals(str(graph.screen('ussd_root')), '1. Apples\n2. Plums\n3. Pears')
+
+    def testScreenCopies(self):
+        graph = get_graph()
+        screen = graph.screen('ussd_root')
+        self.assertEquals(type(screen), Menu)
+        screen.accept_input('9')
+        self.assertTrue(screen.has_errors)
+        self.assertFalse(graph.screen('ussd_root').has_errors)
+
+    def testInvalidateOnSave(self):
+        graph = get_graph()
+        self.assertTrue(get_graph() is graph)
+
+        plums = Menu.objects.get(slug='plums')
+        plums.label = 'Cherries'
+        plums.save()
+        changed = get_graph()
+        self.assertFalse(changed is graph)
+        self.assertEquals(changed.screen('plums').label, 'Cherries')
+
+        Menu.objects.get(slug='pears').delete()
+        self.assertFalse('pears' in get_graph())
+        self.assertEquals(get_graph().child('ussd_root', 3), None)
+
+
+class VersionTest(UssdTestCase):
+
+    def setUp(self):
+        UssdTestCase.setUp(self)
+        self.create_tree()
+        self.connection = Connection.objects.create(identity='8675309', backend=Backend.objects.create(name='dummy'))
+        self.store = DatabaseSessionStore()
+
+    def start(self, transaction_id):
+        session = self.store.create(transaction_id, self.connection)
+        return session, str(session.advance_progress(''))
+
+    def rename(self, slug, label):
+        screen = Menu.objects.get(slug=slug)
+        screen.label = label
+        screen.save()
+
+    def testPinnedVersion(self):
+        activate_version(publish_version())
+        foo, old_root = self.start('foo')
+        self.assertEquals(foo.tree_version, get_active_version())
+
+        self.rename('child1', 'Pears')
+        activate_version(publish_version())
+        bar, new_root = self.start('bar')
+        self.assertNotEquals(bar.tree_version, foo.tree_version)
+        self.assertTrue('Pears' in new_root)
+        self.assertFalse('Pears' in old_root)
+
+        # foo stays on the version it started on
+        foo.advance_progress('1')
+        self.assertEquals(str(foo.advance_progress('#')), old_root)
+        # and so do the texts of its canonical navigations
+        self.assertEquals(foo.navigations.filter(screen='ussd_root')[0].text, old_root)
+
+    def testUnpinnedSession(self):
+        foo, root = self.start('foo')
+        self.assertEquals(foo.tree_version, '')
+
+        activate_version(publish_version())
+        self.rename('child1', 'Pears')
+        bar, version_root = self.start('bar')
+        self.assertFalse('Pears' in version_root)
+
+        # foo isn't moved onto the version activated since it started
+        foo.advance_progress('1')
+        self.assertTrue('Pears' in str(foo.advance_progress('#')))
@@ -0,0 +1,89 @@
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from rapidsms.models import Connection, Backend
+from rapidsms_xforms.models import XForm, XFormField, XFormSubmission
+
+from ussd.benchmark import overridden
+from ussd.models import Menu, Field, StubScreen, Session, Navigation
+from ussd.tests.base import UssdTestCase
+
+
+class SessionTest(UssdTestCase):
+
+    def setUp(self):
+        UssdTestCase.setUp(self)
+        root = self.create_tree()
+
+        owner = User.objects.create_user('test', 'test@test.com', 'test')
+        xform = XForm.objects.create(keyword='test', name='test xform', response='thanks for testing', owner=owner, site=Site.objects.get_current())
+        field1 = XFormField.objects.create(xform=xform, name='t1', field_type=XFormField.TYPE_INT, command='test_t1', question='How old are you?', order=0)
+        field2 = XFormField.objects.create(xform=xform, name='t2', field_type=XFormField.TYPE_INT, command='test_t2', question='How many tests have you run?', order=1)
+        stub = StubScreen.objects.create(slug='stubby')
+        t2 = Field.objects.create(slug='test_t2', field=field2, question_text=field2.question, order=0, next=stub)
+        Field.objects.create(slug='test_t1', field=field1, question_text=field1.question, next=t2, label='Oranges', order=2, parent=root)
+
+        connection = Connection.objects.create(identity='8675309', backend=Backend.objects.create(name='dummy'))
+        self.session = Session.objects.create(connection=connection, transaction_id='foo')
+
+    def hop(self, input):
+        return str(self.session.advance_progress(input))
+
+    def testFieldSurvey(self):
+        self.assertEquals(self.hop(''), str(Menu.objects.get(slug='ussd_root')))
+        self.assertEquals(self.hop('2'), str(Field.objects.get(slug='test_t1')))
+        self.assertEquals(self.hop('45'), str(Field.objects.get(slug='test_t2')))
+        self.assertEquals(self.hop('27'), str(StubScreen.objects.get(slug='stubby')))
+
+        self.assertEquals(self.session.status, 'complete')
+        submission = XFormSubmission.objects.get()
+        self.assertFalse(submission.has_errors)
+        self.assertEquals(list(self.session.submissions.all()), [submission])
+        self.assertEquals(submission.values.count(), 2)
+        self.assertEquals(submission.values.get(attribute__slug='test_test_t1').value_int, 45)
+        self.assertEquals(submission.values.get(attribute__slug='test_test_t2').value_int, 27)
+
+    def testAnswerAgain(self):
+        self.hop('')
+        self.hop('2')
+        self.hop('45')
+        # back to the first question, and answer it again
+        self.hop('#')
+        self.hop('46')
+        self.hop('27')
+
+        submission = XFormSubmission.objects.get()
+        self.assertEquals(submission.values.count(), 2)
+        self.assertEquals(submission.values.get(attribute__slug='test_test_t1').value_int, 46)
+
+    def stack_slugs(self):
+        return [entry[0] for entry in self.session.get_stack()]
+
+    def testStackDepth(self):
+        with overridden(USSD_STACK_DEPTH=2):
+            root = self.hop('')
+            self.hop('2')
+            self.hop('45')
+        # the initial screen is kept, the oldest screen after it is dropped
+        self.assertEquals(self.stack_slugs(), ['ussd_root', 'test_t2'])
+        self.assertEquals(self.hop('#'), root)
+
+    def testBackFromFirstScreen(self):
+        self.hop('')
+        self.assertEquals(self.hop('#'), StubScreen().text)
+        self.assertEquals(self.session.get_stack(), [])
+        # the next hop starts again from the initial screen
+        self.assertEquals(self.hop(''), str(Menu.objects.get(slug='ussd_root')))
+
+    def testErrorText(self):
+        self.hop('')
+        question = self.hop('2')
+        errored = self.hop('not a number')
+        self.assertNotEquals(errored, question)
+        self.assertTrue(question in errored)
+        # the text shown with the error is kept, canonical texts aren't
+        self.assertEquals(self.session.get_stack()[-1][1], errored)
+        self.assertEquals(self.session.get_stack()[-2][1], None)
+
+        self.hop('45')
+        self.assertEquals(self.hop('#'), errored)
+        self.assertEquals(Navigation.objects.get(session=self.session, screen='test_t1', response='45').text, errored)
@@ -0,0 +1,36 @@
+import sys
+
+from django.template import Template, Context
+from django.test import TestCase
+
+from ussd.models import Screen, StubScreen
+
+
+class RecurseTreeTest(TestCase):
+
+    def render(self):
+        template = Template('{% load mptt_tags %}{% recursetree nodes %}[{{ node.slug }}{{ children }}]{% endrecursetree %}')
+        return template.render(Context({'nodes':Screen.objects.order_by('tree_id', 'lft')}))
+
+    def testCachedChildren(self):
+        # 1 + 50 + 50 * 99 = 5001 nodes
+        root = StubScreen.objects.create(slug='root')
+        for i in range(50):
+            menu = StubScreen.objects.create(slug='m%d' % i, parent=root, order=i)
+            for j in range(99):
+                StubScreen.objects.create(slug='m%d_%d' % (i, j), parent=menu, order=j)
+
+        # the tree itself, nothing per node
+        self.assertNumQueries(1, self.render)
+        rendered = self.render()
+        self.assertTrue(rendered.startswith('[root[m0[m0_0][m0_1]'))
+        self.assertEquals(rendered.count('['), 5001)
+
+    def testDeepTree(self):
+        depth = sys.getrecursionlimit() + 100
+        parent = None
+        for i in range(depth):
+            parent = StubScreen.objects.create(slug='d%d' % i, parent=parent)
+
+        rendered = self.render()
+        self.assertEquals(rendered, ''.join('[d%d' % i for i in range(depth)) + ']' * depth)
@@ -0,0 +1,70 @@
+from ussd.models import Screen, Menu, Question
+from ussd.tests.base import UssdTestCase
+from ussd.trees import TreeError, export_trees, import_trees, _number, _check
+
+
+class TreeTest(UssdTestCase):
+
+    def numbering(self, screens):
+        return dict((s.slug, (s.tree_id, s.lft, s.rght, s.level)) for s in screens)
+
+    def testNumber(self):
+        screens = [Menu(slug=slug) for slug in ('ussd_root', 'a', 'b', 'c', 'd')]
+        _number(screens, {'a':'ussd_root', 'b':'a', 'c':'a', 'd':'ussd_root'})
+        self.assertEquals(self.numbering(screens), {
+            'ussd_root':(1, 1, 10, 0),
+            'a':(1, 2, 7, 1),
+            'b':(1, 3, 4, 2),
+            'c':(1, 5, 6, 2),
+            'd':(1, 8, 9, 1),
+        })
+
+    def testNumberAfterExisting(self):
+        Menu.objects.create(slug='existing', label='Existing')
+        screens = [Menu(slug='first'), Menu(slug='second'), Menu(slug='child')]
+        _number(screens, {'child':'second'})
+        existing = Screen.objects.get(slug='existing').tree_id
+        self.assertEquals(self.numbering(screens), {
+            'first':(existing + 1, 1, 2, 0),
+            'second':(existing + 2, 1, 4, 0),
+            'child':(existing + 2, 2, 3, 1),
+        })
+
+    def testCycle(self):
+        screens = [Menu(slug='ussd_root'), Menu(slug='a'), Menu(slug='b')]
+        self.assertRaises(TreeError, _number, screens, {'a':'b', 'b':'a'})
+
+    def create_tree(self):
+        root = UssdTestCase.create_tree(self)
+        Question.objects.create(slug='question', label='Oranges', order=2, parent=root, question_text='Why?',
+                                next=Menu.objects.get(slug='child11'))
+        return root
+
+    def tree_state(self):
+        return dict((s.slug, (type(s), s.parent_id, s.label, s.order, s.lft, s.rght, s.level))
+                    for s in [s.downcast() for s in Screen.objects.all()])
+
+    def testRoundTrip(self):
+        self.create_tree()
+        state = self.tree_state()
+        data = export_trees(['ussd_root'])
+        Screen.objects.get(slug='ussd_root').delete()
+        self.assertEquals(Screen.objects.count(), 0)
+
+        self.assertEquals(import_trees(data), 5)
+        self.assertEquals(self.tree_state(), state)
+        self.assertEquals(Question.objects.get(slug='question').next_id, 'child11')
+        self.assertEquals([s.slug for s in Screen.objects.get(slug='child1').get_descendants()], ['child11', 'child12'])
+
+    def testImportExisting(self):
+        self.create_tree()
+        data = export_trees()
+        self.assertRaises(TreeError, import_trees, data)
+        self.assertEquals(Screen.objects.count(), 5)
+
+    def testCheck(self):
+        self.create_tree()
+        screens = [s.downcast() for s in Screen.objects.all()]
+        _check(screens)
+        Screen.objects.filter(slug='child12').update(rght=99)
+        self.assertRaises(TreeError, _check, screens)
@@ -0,0 +1,250 @@
+"""
+Exporting and importing whole screen trees.
+
+An export is a list of screens in tree order, each a dict of its field
+values, with its model ('ussd.menu', ...), the slug of its parent and, for
+Fields, the XForm keyword and command of the XFormField it is bound to.
+
+Importing doesn't go through the ORM one screen at a time, which would
+have MPTT shift lft/rght across the table on every insert.  Instead the
+lft, rght, level and tree_id of every screen are worked out up front, each
+table gets a single executemany() INSERT, and references between screens
+(parent, next) are filled in with a second pass of UPDATEs, so rows can go
+in in any order.  The whole import is one transaction, and is checked
+before it is committed.
+"""
+from django.db import connection, transaction
+from django.db.models import Max, get_model
+from rapidsms_xforms.models import XFormField
+
+from .graph import load_typed, _concrete_subclasses, invalidate_graph
+from .models import Screen, Field
+
+EXPORT_FORMAT = 1
+
+
+class TreeError(Exception):
+    pass
+
+
+def _label(model):
+    return '%s.%s' % (model._meta.app_label, model._meta.object_name.lower())
+
+
+def _skipped(field):
+    # tree fields are recomputed on import, and parent links follow the slug
+    return field.name in _mptt_fields() or (field.rel and getattr(field.rel, 'parent_link', False))
+
+
+def _mptt_fields():
+    opts = Screen._mptt_meta
+    return (opts.left_attr, opts.right_attr, opts.tree_id_attr, opts.level_attr)
+
+
+def export_trees(roots=None):
+    """
+    Returns the trees under the given root slugs (all trees by default),
+    ready to be serialized.
+    """
+    opts = Screen._mptt_meta
+    screens = Screen.objects.all()
+    if roots:
+        tree_ids = Screen.objects.filter(pk__in=roots).values_list(opts.tree_id_attr, flat=True)
+        screens = screens.filter(**{'%s__in' % opts.tree_id_attr:list(tree_ids)})
+    slugs = list(screens.order_by(opts.tree_id_attr, opts.left_attr).values_list('pk', flat=True))
+    typed = load_typed(slugs)
+
+    exported = []
+    for slug in slugs:
+        screen = typed[slug]
+        data = {'model':_label(type(screen))}
+        for f in type(screen)._meta.fields:
+            if _skipped(f):
+                continue
+            if isinstance(screen, Field) and f.name == 'field':
+                data['field'] = {'xform':screen.field.xform.keyword, 'command':screen.field.command}
+            else:
+                data[f.attname] = getattr(screen, f.attname)
+        exported.append(data)
+    return {'format':EXPORT_FORMAT, 'screens':exported}
+
+
+def _build(data):
+    """
+    Turns exported screens back into unsaved instances, with their tree
+    fields computed, and checks the export is a well-formed set of trees.
+    """
+    if not isinstance(data, dict) or data.get('format') != EXPORT_FORMAT:
+        raise TreeError('Not a screen tree export, or an unsupported format')
+
+    screens = []
+    slugs = set()
+    for i, screen_data in enumerate(data['screens']):
+        model = get_model(*screen_data.get('model', '').split('.'))
+        if model is None or not issubclass(model, Screen):
+            raise TreeError("Screen %d has unknown model '%s'" % (i, screen_data.get('model')))
+        values = {}
+        for f in model._meta.fields:
+            if f.attname in screen_data and not _skipped(f):
+                values[str(f.attname)] = f.to_python(screen_data[f.attname])
+        screen = model(**values)
+        if not screen.slug:
+            raise TreeError('Screen %d has no slug' % i)
+        if screen.slug in slugs:
+            raise TreeError("Slug '%s' is used twice" % screen.slug)
+        slugs.add(screen.slug)
+        if isinstance(screen, Field):
+            try:
+                screen.field_ref = (screen_data['field']['xform'], screen_data['field']['command'])
+            except (KeyError, TypeError):
+                raise TreeError("Field '%s' isn't bound to an XForm field" % screen.slug)
+        screens.append(screen)
+
+    existing = list(Screen.objects.filter(pk__in=slugs).values_list('pk', flat=True)[:10])
+    if existing:
+        raise TreeError('These screens already exist: %s' % ', '.join(existing))
+
+    # Fields are bound by XForm keyword and command, not by pk
+    refs = [s.field_ref for s in screens if isinstance(s, Field)]
+    if refs:
+        fields = dict(((keyword, command), pk) for keyword, command, pk in
+                      XFormField.objects.filter(xform__keyword__in=set(r[0] for r in refs)).values_list('xform__keyword', 'command', 'pk'))
+        for screen in screens:
+            if isinstance(screen, Field):
+                if screen.field_ref not in fields:
+                    raise TreeError("Field '%s' is bound to %s.%s, which doesn't exist" % ((screen.slug,) + screen.field_ref))
+                screen.field_id = fields[screen.field_ref]
+
+    # references to other screens, filled in after everything is inserted
+    references = []
+    for screen in screens:
+        for f in type(screen)._meta.fields:
+            if f.rel and not _skipped(f) and issubclass(f.rel.to, Screen):
+                target = getattr(screen, f.attname)
+                if target is None:
+                    continue
+                if f.name == 'parent' and target not in slugs:
+                    raise TreeError("Parent '%s' of '%s' isn't part of the export" % (target, screen.slug))
+                references.append((f, screen.slug, target))
+                setattr(screen, f.attname, None)
+
+    targets = set(t for f, slug, t in references if t not in slugs)
+    missing = targets - set(Screen.objects.filter(pk__in=targets).values_list('pk', flat=True))
+    if missing:
+        raise TreeError('Unknown screens referred to: %s' % ', '.join(sorted(missing)))
+
+    _number(screens, dict((slug, t) for f, slug, t in references if f.name == 'parent'))
+    return screens, references
+
+
+def _number(screens, parents):
+    """
+    Sets lft, rght, level and tree_id on every screen, numbering new trees
+    after the existing ones.  Children keep the order they were exported in.
+    """
+    opts = Screen._mptt_meta
+    children = {}
+    roots = []
+    for screen in screens:
+        parent = parents.get(screen.slug)
+        if parent is None:
+            roots.append(screen)
+        else:
+            children.setdefault(parent, []).append(screen)
+
+    tree_id = Screen._tree_manager.aggregate(m=Max(opts.tree_id_attr))['m'] or 0
+    numbered = 0
+    for root in roots:
+        tree_id += 1
+        counter = 1
+        setattr(root, opts.left_attr, counter)
+        setattr(root, opts.level_attr, 0)
+        # (screen, remaining children) pairs, walked depth first
+        stack = [(root, iter(children.get(root.slug, [])))]
+        while stack:
+            screen, remaining = stack[-1]
+            setattr(screen, opts.tree_id_attr, tree_id)
+            for child in remaining:
+                counter += 1
+                setattr(child, opts.left_attr, counter)
+                setattr(child, opts.level_attr, len(stack))
+                stack.append((child, iter(children.get(child.slug, []))))
+                break
+            else:
+                counter += 1
+                setattr(screen, opts.right_attr, counter)
+                stack.pop()
+                numbered += 1
+    if numbered != len(screens):
+        raise TreeError('The parent links of %d screens form a cycle' % (len(screens) - numbered))
+
+
+def _insert(screens):
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    models = [Screen] + list(set(_concrete_subclasses(Screen)))
+    # parents' tables first
+    models.sort(key=lambda m: len(m.__mro__))
+    for model in models:
+        rows = [s for s in screens if isinstance(s, model)]
+        if not rows:
+            continue
+        fields = model._meta.local_fields
+        sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+            qn(model._meta.db_table),
+            ', '.join(qn(f.column) for f in fields),
+            ', '.join(['%s'] * len(fields)))
+        cursor.executemany(sql, [[f.get_db_prep_save(_value(f, s), connection=connection) for f in fields] for s in rows])
+
+
+def _value(field, screen):
+    if field.rel and getattr(field.rel, 'parent_link', False):
+        # every table in the chain is keyed by the slug
+        return screen.slug
+    return field.pre_save(screen, True)
+
+
+def _link(references):
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    by_field = {}
+    for f, slug, target in references:
+        by_field.setdefault(f, []).append((target, slug))
+    for f, pairs in by_field.items():
+        model = f.model
+        sql = 'UPDATE %s SET %s = %%s WHERE %s = %%s' % (
+            qn(model._meta.db_table), qn(f.column), qn(model._meta.pk.column))
+        cursor.executemany(sql, pairs)
+
+
+def import_trees(data):
+    """
+    Imports exported trees as new trees, in one transaction.  Raises
+    TreeError, leaving the database as it was, if the export isn't valid.
+    Returns the number of screens imported.
+    """
+    screens, references = _build(data)
+    with transaction.commit_on_success():
+        _insert(screens)
+        _link(references)
+        # raw queries don't mark the transaction as needing a commit
+        transaction.set_dirty()
+        _check(screens)
+    invalidate_graph()
+    return len(screens)
+
+
+def _check(screens):
+    opts = Screen._mptt_meta
+    typed = load_typed([s.slug for s in screens])
+    for screen in screens:
+        loaded = typed.get(screen.slug)
+        if type(loaded) is not type(screen):
+            raise TreeError("'%s' was imported as %s" % (screen.slug, type(loaded).__name__))
+        for attr in _mptt_fields():
+            if getattr(loaded, attr) != getattr(screen, attr):
+                raise TreeError("'%s' has the wrong %s after import" % (screen.slug, attr))
+    for root in [s for s in screens if getattr(s, opts.level_attr) == 0]:
+        size = Screen._tree_manager.filter(**{opts.tree_id_attr:getattr(root, opts.tree_id_attr)}).count()
+        if getattr(root, opts.right_attr) != size * 2:
+            raise TreeError("Tree '%s' has %d screens, but its numbering is off" % (root.slug, size))
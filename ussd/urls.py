@@ -3,4 +3,5 @@ from . import views
 
 urlpatterns = patterns('',
     url(r"^ussd/$", views.ussd, name="ussd-gateway"),
+    url(r"^ussd/pooled/$", views.ussd_pooled, name="ussd-gateway-pooled"),
 )
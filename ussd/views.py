@@ -1,26 +1,150 @@
+from .deadline import DeadlineExceeded, new_deadline, run_after_response, within
 from .forms import YoForm
+from .graph import get_graph
+from .instrumentation import bound, carried, current_hop, instrument, record_screen, timed
+from .models import StubScreen
+from .store import get_session_store
+from .workers import WorkerPool, PoolFull
+from django.conf import settings
 from django.forms import ValidationError
 from django.http import HttpResponse
 from django.shortcuts import render_to_response
 from django.template import RequestContext
+import threading
 import urllib
 
 
-def ussd(req, input_form=YoForm, request_method='POST', output_template='ussd/yo.txt'):
-    form = None
+def get_form(req, input_form):
     if req.method == 'GET' and req.GET:
-        form = input_form(req.GET)
+        return input_form(req.GET)
     elif req.method == 'POST' and req.POST:
-        form = input_form(req.POST)
-    if form and form.is_valid():
+        return input_form(req.POST)
+    return None
+
+
+def get_retry_screen(session=None):
+    '''
+    The screen sent when a hop runs out of time: USSD_RETRY_SCREEN if
+    that names a screen, otherwise USSD_RETRY_TEXT followed by the
+    screen the subscriber was answering.
+    '''
+    slug = getattr(settings, 'USSD_RETRY_SCREEN', None)
+    graph = session.get_graph() if session else get_graph()
+    if slug and slug in graph:
+        return graph.screen(slug)
+    text = getattr(settings, 'USSD_RETRY_TEXT', 'Sorry, that took too long, please try again.')
+    entry = session and session.last_navigation()
+    if entry:
+        text = "%s\n%s" % (text, session.navigation_text(entry))
+    return StubScreen(text=text, terminal=False)
+
+
+def process_hop(form, deadline=None):
+    '''
+    Cleans the gateway's request, and advances its session.  Returns
+    the screen to respond with, or None if the request was invalid.
+    '''
+    with within(deadline):
+        with timed('clean'):
+            valid = form and form.is_valid()
+        if not valid:
+            return None
+
         session = form.cleaned_data['transactionId']
         request_string = form.cleaned_data['ussdRequestString']
 
-        response_screen = session.advance_progress(request_string)
-        action = 'end' if response_screen.is_terminal() else 'request'
-        return render_to_response(output_template, {
+        try:
+            with timed('advance_progress'):
+                response_screen = session.advance_progress(request_string)
+        except DeadlineExceeded:
+            # leave the session as it was, the subscriber will send
+            # the same input again
+            deadline.deferred = []
+            return get_retry_screen(session)
+    record_screen(response_screen)
+    store = get_session_store()
+    with timed('store'):
+        if response_screen.is_terminal():
+            store.finish(session)
+        else:
+            store.save(session)
+    return response_screen
+
+
+def render_screen(req, response_screen, output_template, deadline=None):
+    with timed('render'):
+        response = render_to_response(output_template, {
             'response_content':urllib.quote(str(response_screen)),
-            'action':action,
+            'action':'end' if response_screen.is_terminal() else 'request',
         }, context_instance=RequestContext(req))
+    if deadline is not None and deadline.deferred:
+        run_after_response(response, carried(deadline.run_deferred))
+    return response
+
+
+@instrument
+def ussd(req, input_form=YoForm, request_method='POST', output_template='ussd/yo.txt'):
+    deadline = new_deadline()
+    response_screen = process_hop(get_form(req, input_form), deadline)
+    if response_screen is None:
+        return HttpResponse(status=404)
+    return render_screen(req, response_screen, output_template, deadline)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_hop_pool():
+    global _pool
+    if _pool is None:
+        _pool_lock.acquire()
+        try:
+            if _pool is None:
+                _pool = WorkerPool(getattr(settings, 'USSD_HOP_WORKERS', 10),
+                                   getattr(settings, 'USSD_HOP_QUEUE_SIZE', 100),
+                                   name='ussd-hop')
+        finally:
+            _pool_lock.release()
+    return _pool
+
+
+def _process_hop_bound(hop, form, deadline):
+    with bound(hop):
+        return process_hop(form, deadline)
+
+
+@instrument
+def ussd_pooled(req, input_form=YoForm, request_method='POST', output_template='ussd/yo.txt'):
+    '''
+    A variant of the ussd view that hands each hop's database and store
+    work to a bounded pool of USSD_HOP_WORKERS threads.  When the pool
+    and its queue are full, the gateway immediately gets a USSD_BUSY_TEXT
+    screen asking the subscriber to try again, leaving the dialog and its
+    session open, rather than the request waiting on the database.  With
+    a USSD_HOP_DEADLINE, a hop that is still running when the deadline
+    passes is abandoned, and the subscriber asked to retry.
+
+    This bounds the hops (and database connections) working at once, not
+    the requests being served: the request's own thread still waits for
+    its hop, so the web server needs a thread for every in-flight request,
+    up to USSD_HOP_WORKERS + USSD_HOP_QUEUE_SIZE of them, plus those
+    being turned away.
+    '''
+    form = get_form(req, input_form)
+    if form is None:
+        return HttpResponse(status=404)
+    deadline = new_deadline()
+    try:
+        task = get_hop_pool().submit(_process_hop_bound, current_hop(), form, deadline)
+    except PoolFull:
+        response_screen = StubScreen(text=getattr(settings, 'USSD_BUSY_TEXT', 'The service is busy, please try again.'), terminal=False)
+        return render_screen(req, response_screen, output_template)
+
+    if deadline is not None and not task.wait(deadline.remaining()) and deadline.abandon():
+        return render_screen(req, get_retry_screen(), output_template)
 
-    return HttpResponse(status=404)
+    response_screen = task.get()
+    if response_screen is None:
+        return HttpResponse(status=404)
+    return render_screen(req, response_screen, output_template, deadline)
@@ -0,0 +1,175 @@
+"""
+A small, bounded pool of worker threads.
+
+Each pool runs at most ``size`` tasks at once, and queues at most
+``queue_size`` more; submitting beyond that raises PoolFull straight away,
+rather than letting work pile up behind a slow database.  Every worker
+thread holds its own database connection, so the pool size also bounds
+the number of connections the work can use.
+
+run_in_background() hands work to a shared pool of USSD_SIGNAL_WORKERS
+threads, used to send signals (see send_with_retry) without holding up
+the gateway's response.
+"""
+import Queue
+import atexit
+import logging
+import sys
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+
+class PoolFull(Exception):
+    pass
+
+
+class Task(object):
+
+    def __init__(self, fn, args, kwargs):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.result = None
+        self.exc_info = None
+        self.done = threading.Event()
+
+    def run(self):
+        try:
+            self.result = self.fn(*self.args, **self.kwargs)
+        except Exception:
+            self.exc_info = sys.exc_info()
+        self.done.set()
+
+    def wait(self, timeout=None):
+        """
+        Waits for the task to finish, returns False if it didn't
+        within ``timeout`` seconds.
+        """
+        self.done.wait(timeout)
+        return self.done.isSet()
+
+    def get(self):
+        """
+        Waits for the task, and returns its result (or raises
+        its exception).
+        """
+        self.done.wait()
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+
+class WorkerPool(object):
+
+    def __init__(self, size=10, queue_size=100, name='ussd-worker'):
+        self.size = size
+        self.name = name
+        self.queue = Queue.Queue(queue_size)
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.lock.acquire()
+        try:
+            while len(self.threads) < self.size:
+                t = threading.Thread(target=self.run, name='%s-%d' % (self.name, len(self.threads)))
+                t.setDaemon(True)
+                t.start()
+                self.threads.append(t)
+        finally:
+            self.lock.release()
+
+    def submit(self, fn, *args, **kwargs):
+        if len(self.threads) < self.size:
+            self.start()
+        task = Task(fn, args, kwargs)
+        try:
+            self.queue.put_nowait(task)
+        except Queue.Full:
+            raise PoolFull('%s has %d tasks waiting' % (self.name, self.queue.qsize()))
+        return task
+
+    def run(self):
+        while True:
+            task = self.queue.get()
+            try:
+                task.run()
+            finally:
+                self.queue.task_done()
+
+    def join(self):
+        """
+        Blocks until every queued task has run.
+        """
+        self.queue.join()
+
+
+def send_with_retry(signal, sender, reconnect=True, **kwargs):
+    """
+    Sends ``signal`` to all its receivers, retrying each receiver that
+    raises up to USSD_SIGNAL_RETRIES times, backing off from
+    USSD_SIGNAL_RETRY_DELAY seconds, before logging it as failed.  Unless
+    ``reconnect`` is False, the database connection is closed before each
+    retry, so only send with it outside of a transaction.
+    """
+    retries = getattr(settings, 'USSD_SIGNAL_RETRIES', 3)
+    delay = getattr(settings, 'USSD_SIGNAL_RETRY_DELAY', 1.0)
+    for receiver, response in signal.send_robust(sender=sender, **kwargs):
+        attempt = 0
+        while isinstance(response, Exception):
+            if reconnect:
+                # the connection may be what failed, start afresh
+                connection.close()
+            if attempt == retries:
+                logger.error('%r failed for %r after %d attempts: %s' % (receiver, sender, attempt + 1, response))
+                break
+            time.sleep(delay * 2 ** attempt)
+            attempt += 1
+            try:
+                response = receiver(signal=signal, sender=sender, **kwargs)
+            except Exception, e:
+                response = e
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_background_pool():
+    global _pool
+    if _pool is None:
+        _pool_lock.acquire()
+        try:
+            if _pool is None:
+                _pool = WorkerPool(getattr(settings, 'USSD_SIGNAL_WORKERS', 4),
+                                   getattr(settings, 'USSD_SIGNAL_QUEUE_SIZE', 1000),
+                                   name='ussd-signal')
+                # let queued work finish before the process exits
+                atexit.register(_pool.join)
+        finally:
+            _pool_lock.release()
+    return _pool
+
+
+def run_in_background(fn, *args, **kwargs):
+    """
+    Runs ``fn`` on the background pool, or right away if its queue is full.
+    """
+    try:
+        return get_background_pool().submit(_log_failure, fn, *args, **kwargs)
+    except PoolFull:
+        logger.warning('Background pool is full, running %r inline' % fn)
+        return fn(*args, **kwargs)
+
+
+def _log_failure(fn, *args, **kwargs):
+    try:
+        return fn(*args, **kwargs)
+    except Exception:
+        logger.exception('%r failed in the background' % fn)
+        raise